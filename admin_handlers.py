@@ -1,6 +1,7 @@
 import datetime as dt
 from collections import defaultdict
-from itertools import product, zip_longest
+from io import BytesIO
+from itertools import groupby, zip_longest
 
 import xlsxwriter
 from psycopg2 import Error as DBError
@@ -10,6 +11,7 @@ from telegram.ext import ConversationHandler
 import db
 import student_lists
 import telegramcalendar
+from availability import index as availability
 from config import (
     CLASSES_HOURS,
     DATE_FORMAT,
@@ -17,6 +19,7 @@ from config import (
     REMOVE_SCHEDULE_STATE,
     WEEKDAYS
 )
+from schedule_report import report
 from tools import (
     ReplyKeyboardWithCancel,
     logger,
@@ -102,18 +105,16 @@ def add_schedule_continue(bot, update, args):
                          text="Что-то дат не то количество... Должны быть: первый день и последний. "
                               "Попробуй еще раз.")
         return
-    day = start
-    if start and end:
-        while day <= end:
-            for place, time in product(PLACES, CLASSES_HOURS):
-                try:
-                    db.execute_insert(db.add_classes_dates_sql, (place, day.isoformat(), time, True))
-                except:
-                    bot.send_message(chat_id=update.message.chat_id, text="Косяк! Что-то не получилось")
-                    return
-            day += dt.timedelta(days=1)
-    bot.send_message(chat_id=update.message.chat_id, text="Ок! Добавил даты с {} по {}. "
-                                                          "Все верно?".format(start, end))
+    try:
+        created, existing = db.add_classes(start, end, PLACES, CLASSES_HOURS)
+        availability.classes_added(start, end, PLACES, CLASSES_HOURS)
+    except DBError:
+        bot.send_message(chat_id=update.message.chat_id, text="Косяк! Что-то не получилось")
+        return
+    text = "Ок! Добавил даты с {} по {}. Создано слотов: {}".format(start, end, created)
+    if existing:
+        text += ", уже существовало: {}".format(existing)
+    bot.send_message(chat_id=update.message.chat_id, text=text + ". Все верно?")
 
 
 @restricted(msg="Только администратор может удалять расписание!", returns=ConversationHandler.END)
@@ -197,23 +198,19 @@ def remove(bot, update, args, user_data):
     return REMOVE_SCHEDULE_STATE
 
 
-def remove_classes(date, time=None, place=None):
+def remove_classes(start, end, time=None, place=None):
     """Remove classes from schedule
 
-    :param date: the date to remove classes from
+    :param start: the first date to remove classes from
+    :param end: the last date to remove classes from
     :param time: is optional, if given only this time is removed
-    :return: None
+    :param place: list of places to remove classes from
+    :return: tuple (removed classes, displaced bookings) count
     """
-    if not time:
-        # remove schedule records for classes for given date
-        classes_ids = db.execute_select(db.get_classes_ids_by_date_sql, (date, place))
-        classes_ids = list(map(lambda x: x[0], classes_ids))
-    else:
-        # remove schedule records for classes for given date and time
-        classes_ids = db.execute_select(db.get_classes_ids_by_date_time_sql, (date, time, place))
-        classes_ids = list(map(lambda x: x[0], classes_ids))
-    db.execute_insert(db.get_delete_schedules_for_classes_sql, (classes_ids,))
-    db.execute_insert(db.get_delete_classes_sql, (classes_ids,))
+    removed = db.remove_classes(start, end, place, time)
+    report.remove_classes(start, end, place, time)
+    availability.classes_removed(start, end, place, time)
+    return removed
 
 
 def remove_schedule_continue(bot, update, user_data):
@@ -239,16 +236,13 @@ def remove_schedule_continue(bot, update, user_data):
     if not end:
         end = start
     if start and end:
-        day = start
-        while day <= end:
-            try:
-                remove_classes(day, time, place)
-            except DBError:
-                bot.send_message(chat_id=update.message.chat_id,
-                                 text="Косяк! Что-то не получилось.",
-                                 reply_markup=ReplyKeyboardRemove())
-                return ConversationHandler.END
-            day += dt.timedelta(days=1)
+        try:
+            removed_classes, removed_bookings = remove_classes(start, end, time, place)
+        except DBError:
+            bot.send_message(chat_id=update.message.chat_id,
+                             text="Косяк! Что-то не получилось.",
+                             reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
     else:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Что-то пошло не так. Непонятно что удалять.",
@@ -260,41 +254,23 @@ def remove_schedule_continue(bot, update, user_data):
     if time:
         message += " {}".format(time)
     message += " на площадку {}.".format(place)
+    message += " Удалено занятий: {}, отменено записей: {}.".format(removed_classes, removed_bookings)
     bot.send_message(chat_id=update.message.chat_id,
                      text=message,
                      reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
-@restricted(msg="Расписание покажу только администратору!")
-def schedule(bot, update, args):
-    add_count = False
-    full_schedule = False
-    if len(args) > 0:
-        if args[0] not in ('++', 'all'):
-            bot.send_message(chat_id=update.message.chat_id, text="Наверное аргумент неправильный.")
-            return
-        add_count = args[0] == '++'
-        full_schedule = args[0] == 'all'
+def write_schedule_report(rows, output, add_count=False):
+    """Write schedule rows into the xlsx workbook
 
-    if full_schedule:
-        schedule = db.execute_select(db.get_full_schedule_sql, (dt.date(2019, 4, 1).isoformat(),))
-    else:
-        schedule = db.execute_select(db.get_full_schedule_sql, (dt.date.today().isoformat(),))
-
-    user_ids = list(set(map(lambda x: x[5] or 'unknown', schedule)))
-    user_count = db.execute_select(db.get_user_visits_count, (dt.date.today().isoformat(), user_ids))
-    user_count = dict(user_count)
-    lines = [(line[0], str(line[1]), line[2],  # place, date, time
-                       str(line[3]), line[4],  # GroupNum LastName
-                       str(user_count.get(line[5], 0)))  # visit count
-             for line in schedule]
-    # partition by places
-    records_by_date_place = defaultdict(list)
-    for line in lines:
-        # group by date+place
-        records_by_date_place[(line[1], line[0])].append(line)
-    workbook = xlsxwriter.Workbook('/tmp/schedule.xlsx')
+    :param rows: iterable of (date, place, time, group_num, last_name, visits) grouped by
+        date and place and sorted by last name inside a group
+    :param output: file name or file-like object to write the workbook to
+    :param add_count: add students visits count
+    """
+    # constant memory mode flushes every row to disk once the next one is started
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
     try:
         merge_format = workbook.add_format({
             'align': 'center',
@@ -302,13 +278,10 @@ def schedule(bot, update, args):
         })
         worksheet = workbook.add_worksheet()
         row = 0
-        for key in sorted(records_by_date_place.keys()):
-            records = records_by_date_place[key]
+        for (date, place), records in groupby(rows, key=lambda x: (x[0], x[1])):
             row += 1
             # merge cells and write 'day date place'
-            date = dt.datetime.strptime(key[0], DATE_FORMAT).date()
             day = WEEKDAYS[date.weekday()]
-            place = key[1]
             worksheet.merge_range(row, 1, row, 4, f"{day}, {date}, {place}", merge_format)
             row += 1
             # write time slots
@@ -318,7 +291,7 @@ def schedule(bot, update, args):
                 col += 1
             row += 1
             students_lists = defaultdict(list)
-            for line in sorted(records, key=lambda x: x[4] or ''):  # sort by last name
+            for line in records:
                 string = f"{line[3]} {line[4]} ({line[5]})" if add_count else f"{line[3]} {line[4]}"
                 students_lists[line[2]].append(string)
             lines = []
@@ -330,11 +303,35 @@ def schedule(bot, update, args):
                     worksheet.write(row, col, val)
                     col += 1
                 row += 1
-    except Exception as e:
-        logger.error(e)
     finally:
         workbook.close()
-        bot.send_document(chat_id=update.message.chat_id, document=open('/tmp/schedule.xlsx', 'rb'))
+
+
+@restricted(msg="Расписание покажу только администратору!")
+def schedule(bot, update, args):
+    add_count = False
+    full_schedule = False
+    if len(args) > 0:
+        if args[0] not in ('++', 'all'):
+            bot.send_message(chat_id=update.message.chat_id, text="Наверное аргумент неправильный.")
+            return
+        add_count = args[0] == '++'
+        full_schedule = args[0] == 'all'
+
+    output = BytesIO()
+    try:
+        if full_schedule:
+            rows = db.stream_select(db.get_schedule_report_sql, {'start': dt.date(2019, 4, 1).isoformat()})
+        else:
+            visits = None
+            if add_count:
+                visits = db.get_user_visits(report.user_ids())
+            rows = report.rows(visits)
+        write_schedule_report(rows, output, add_count)
+    except Exception as e:
+        logger.error(e)
+    output.seek(0)
+    bot.send_document(chat_id=update.message.chat_id, document=output, filename='schedule.xlsx')
 
 
 @restricted(msg="Только администратор может разрешать запись на занятия!")
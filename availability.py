@@ -0,0 +1,126 @@
+"""
+In-process index of free seats: place -> date -> time -> remaining seats.
+
+The index is loaded at startup, updated by every booking, cancellation,
+schedule addition and removal, and periodically reconciled against the db.
+It serves the date and time keyboards of the subscribe dialog without
+db round trips.
+"""
+import datetime as dt
+import threading
+import time as _time
+
+import db
+from config import AVAILABILITY_RECONCILE_INTERVAL, DATE_FORMAT, PEOPLE_PER_TIME_SLOT
+from tools import logger
+
+# min seconds between reloads of the index marked stale by other processes
+STALE_RELOAD_INTERVAL = 1
+
+
+def _to_date(date):
+    if isinstance(date, str):
+        return dt.datetime.strptime(date, DATE_FORMAT).date()
+    return date
+
+
+class AvailabilityIndex:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._seats = {}
+        self._loaded = False
+        self._stale = False
+        self._loaded_at = 0
+
+    def load(self):
+        """(Re)load the upcoming classes free seats from the db"""
+        seats = {}
+        rows = db.execute_select(db.get_classes_occupancy_sql, (dt.date.today().isoformat(),))
+        for place, date, time, people in rows:
+            seats.setdefault(place, {}).setdefault(date, {})[time] = max(self.capacity - people, 0)
+        with self._lock:
+            self._seats = seats
+            self._loaded = True
+            self._stale = False
+            self._loaded_at = _time.monotonic()
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+        elif self._stale and _time.monotonic() - self._loaded_at >= STALE_RELOAD_INTERVAL:
+            self.load()
+
+    def mark_stale(self):
+        """The classes were changed by another process, reload on next use"""
+        self._stale = True
+
+    def open_dates(self, place, start):
+        """Return sorted list of (date, free seats) with free seats since the start date"""
+        self._ensure_loaded()
+        start = _to_date(start)
+        with self._lock:
+            dates = self._seats.get(place, {})
+            result = [(date, sum(times.values())) for date, times in dates.items() if date >= start]
+        return sorted((date, free) for date, free in result if free > 0)
+
+    def open_times(self, place, date):
+        """Return sorted list of (time, free seats) of the classes with free seats"""
+        self._ensure_loaded()
+        with self._lock:
+            times = self._seats.get(place, {}).get(_to_date(date), {})
+            return sorted((time, free) for time, free in times.items() if free > 0)
+
+    def _change(self, place, date, time, delta):
+        with self._lock:
+            times = self._seats.get(place, {}).get(_to_date(date))
+            if times is not None and time in times:
+                times[time] = min(max(times[time] + delta, 0), self.capacity)
+
+    def booked(self, place, date, time):
+        self._change(place, date, time, -1)
+
+    def unbooked(self, place, date, time):
+        self._change(place, date, time, 1)
+
+    def full(self, place, date, time):
+        self._change(place, date, time, -self.capacity)
+
+    def classes_added(self, start, end, places, hours):
+        with self._lock:
+            day = _to_date(start)
+            while day <= _to_date(end):
+                for place in places:
+                    times = self._seats.setdefault(place, {}).setdefault(day, {})
+                    for time in hours:
+                        times.setdefault(time, self.capacity)
+                day += dt.timedelta(days=1)
+
+    def classes_removed(self, start, end, places, time=None):
+        start, end = _to_date(start), _to_date(end)
+        with self._lock:
+            for place in places:
+                dates = self._seats.get(place, {})
+                for date in [date for date in dates if start <= date <= end]:
+                    if time is None:
+                        del dates[date]
+                    else:
+                        dates[date].pop(time, None)
+
+    def reconcile(self, bot, job):
+        """Job callback reloading the index from the db"""
+        try:
+            self.load()
+        except db.DatabaseError as e:
+            logger.error("Availability reconcile failed: %s", e)
+
+
+index = AvailabilityIndex(PEOPLE_PER_TIME_SLOT)
+
+
+def start_availability(job_queue):
+    """Load the index and schedule its periodic reconciliation"""
+    index.load()
+    job_queue.run_repeating(index.reconcile, AVAILABILITY_RECONCILE_INTERVAL,
+                            first=AVAILABILITY_RECONCILE_INTERVAL, name="availability_reconcile")
@@ -0,0 +1,279 @@
+"""
+Benchmark of the booking and admin flows.
+
+Drives the real handlers with a recording fake bot and synthetic updates
+against a local Postgres and reports per-handler latency percentiles, and
+db round trips and peak and retained traced memory per flow. Memory is
+measured in a second run, as tracing slows down every allocation. It also checks that the hot queries
+are planned with the indexes added for them. Results may be saved as a
+baseline and later runs compared against it to catch regressions.
+
+Usage:
+    DB_SSLMODE=disable DATABASE_URL=postgres://localhost/bench_db BOT_TOKEN=x ADMIN_IDS=1 \\
+        python3 benchmark.py [--iterations 50] [--save-baseline | --compare] [--baseline benchmark_baseline.json]
+
+The database is migrated and filled with benchmark users and classes, don't point it to production.
+"""
+import argparse
+import datetime as dt
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+
+import admin_handlers
+import db
+import user_handlers
+from config import CLASSES_HOURS, DATABASE_URL, LIST_OF_ADMINS, PLACES
+
+ADMIN_ID = LIST_OF_ADMINS[0]
+FIRST_STUDENT_ID = 900000
+BENCH_GROUP_NUM = 9999
+
+
+class FakeBot:
+    """Bot recording every call instead of talking to Telegram"""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            with self._lock:
+                self.calls.append((name, args, kwargs))
+            return SimpleNamespace(message_id=len(self.calls))
+        return method
+
+    def replies(self, chat_id):
+        with self._lock:
+            return [kwargs.get('text') for name, args, kwargs in self.calls
+                    if name == 'send_message' and kwargs.get('chat_id') == chat_id]
+
+
+def make_update(bot, user_id, text="", username="bench"):
+    """Build a synthetic private chat text update"""
+    user = SimpleNamespace(id=user_id, username=username, first_name="Bench", last_name=str(user_id))
+    message = SimpleNamespace(
+        text=text,
+        chat_id=user_id,
+        reply_text=lambda text, **kwargs: bot.send_message(chat_id=user_id, text=text, **kwargs),
+    )
+    return SimpleNamespace(message=message, effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+                           effective_message=message, callback_query=None)
+
+
+def prepare_db(students, first_id=FIRST_STUDENT_ID):
+    """Migrate the db and create benchmark users and the upcoming classes"""
+    conn = db.create_connection(DATABASE_URL)
+    db.migrate(conn)
+    conn.close()
+    db.execute_insert(db.set_settings_param_value, ("yes", "allow"))
+    for num in range(students):
+        user_id = first_id + num
+        db.upsert_user(user_id, "bench", "Bench", str(user_id))
+        db.execute_insert(db.update_user_group_sql, (BENCH_GROUP_NUM, user_id))
+    start = dt.date.today() + dt.timedelta(days=1)
+    db.add_classes(start, start + dt.timedelta(days=5), PLACES, CLASSES_HOURS)
+
+
+def index_checks(first_id=FIRST_STUDENT_ID):
+    """Return list of (query name, sql, values, index expected in its plan)"""
+    today = dt.date.today().isoformat()
+    return [
+        ("get_classes_occupancy_sql", db.get_classes_occupancy_sql, (today,), "classes_date_place_open_idx"),
+        ("get_schedule_for_date_sql", db.get_schedule_for_date_sql, (today,), "classes_date_place_open_idx"),
+        ("get_users_sql", db.get_users_sql, (BENCH_GROUP_NUM,), "users_group_num_idx"),
+        ("get_user_context_sql", db.get_user_context_sql, {'user_id': first_id, 'since': today}, "schedule_pkey"),
+        ("get_user_visits_sql", db.get_user_visits_sql, ([first_id],), "user_visits_pkey"),
+    ]
+
+
+def check_indexes():
+    """Return query name -> whether its plan uses the expected index
+
+    Sequential scans are disabled, so the benchmark tables size doesn't matter,
+    a query the index doesn't fit is still planned with a sequential scan.
+    """
+    return {name: db.uses_index(sql, values, index, seqscan=False)
+            for name, sql, values, index in index_checks()}
+
+
+class Recorder:
+    """Collects per-handler latencies and per-flow round trips or memory use"""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.latencies = defaultdict(list)
+        self.round_trips = defaultdict(list)
+        self.peak_kb = defaultdict(list)
+        self.retained_kb = defaultdict(list)
+        self._queries = 0
+
+    def on_query(self, sql, seconds, failed):
+        self._queries += 1
+
+    def timed(self, name, handler, *args):
+        started = time.perf_counter()
+        result = handler(*args)
+        self.latencies[name].append(time.perf_counter() - started)
+        return result
+
+    def flow(self, name, body):
+        self._queries = 0
+        if self.trace_memory:
+            # resets the peak too, the blocks allocated earlier are not tracked anymore
+            tracemalloc.clear_traces()
+        body()
+        self.round_trips[name].append(self._queries)
+        if self.trace_memory:
+            retained, peak = tracemalloc.get_traced_memory()
+            self.peak_kb[name].append(peak / 1024)
+            self.retained_kb[name].append(retained / 1024)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def booking_flow(recorder, bot, user_id, place, date, time_slot):
+    def body():
+        user_data = {}
+        recorder.timed("ask_place", user_handlers.ask_place, bot, make_update(bot, user_id, "Запиши меня"),
+                       user_data)
+        recorder.timed("ask_date", user_handlers.ask_date, bot, make_update(bot, user_id, place), user_data)
+        recorder.timed("ask_time", user_handlers.ask_time, bot, make_update(bot, user_id, date), user_data)
+        recorder.timed("store_sign_up", user_handlers.store_sign_up, bot,
+                       make_update(bot, user_id, time_slot), user_data)
+    recorder.flow("booking", body)
+
+
+def unsubscribe_flow(recorder, bot, user_id, place, date, time_slot):
+    def body():
+        recorder.timed("unsubscribe", user_handlers.unsubscribe, bot,
+                       make_update(bot, user_id, "{} {} {}".format(place, date, time_slot)))
+    recorder.flow("unsubscribe", body)
+
+
+def admin_flows(recorder, bot):
+    start = dt.date.today() + dt.timedelta(days=6)
+    args = [start.isoformat(), start.isoformat()]
+
+    def add_body():
+        recorder.timed("add_schedule", admin_handlers.add_schedule_continue, bot,
+                       make_update(bot, ADMIN_ID, "/add_schedule"), args)
+    recorder.flow("add_schedule", add_body)
+
+    def remove_body():
+        user_data = {}
+        recorder.timed("remove", admin_handlers.remove, bot, make_update(bot, ADMIN_ID, "/remove"),
+                       [start.isoformat()], user_data)
+        recorder.timed("remove_schedule_continue", admin_handlers.remove_schedule_continue, bot,
+                       make_update(bot, ADMIN_ID, "Обе"), user_data)
+    recorder.flow("remove", remove_body)
+
+    def schedule_body():
+        recorder.timed("schedule", admin_handlers.schedule, bot, make_update(bot, ADMIN_ID, "/schedule"), [])
+    recorder.flow("schedule", schedule_body)
+
+
+def run_flows(recorder, iterations):
+    date = (dt.date.today() + dt.timedelta(days=2)).isoformat()
+    for num in range(iterations):
+        bot = FakeBot()
+        user_id = FIRST_STUDENT_ID + num
+        place = PLACES[num % len(PLACES)]
+        time_slot = CLASSES_HOURS[num % len(CLASSES_HOURS)]
+        booking_flow(recorder, bot, user_id, place, date, time_slot)
+        unsubscribe_flow(recorder, bot, user_id, place, date, time_slot)
+        admin_flows(recorder, bot)
+
+
+def run(iterations):
+    prepare_db(iterations)
+    timing = Recorder()
+    db.add_query_observer(timing.on_query)
+    try:
+        run_flows(timing, iterations)
+    finally:
+        db.remove_query_observer(timing.on_query)
+    memory = Recorder(trace_memory=True)
+    tracemalloc.start()
+    try:
+        run_flows(memory, iterations)
+    finally:
+        tracemalloc.stop()
+    return {
+        'indexes': check_indexes(),
+        'handlers': {name: {'p50_ms': percentile(values, 0.5) * 1000, 'p99_ms': percentile(values, 0.99) * 1000}
+                     for name, values in timing.latencies.items()},
+        'flows': {name: {'round_trips': max(timing.round_trips[name]),
+                         'peak_kb': percentile(memory.peak_kb[name], 0.5),
+                         'retained_kb': percentile(memory.retained_kb[name], 0.5)}
+                  for name in timing.round_trips},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions against the baseline"""
+    regressions = ["{}: the index is not used".format(name)
+                   for name, used in results['indexes'].items() if not used]
+    for name, stats in results['handlers'].items():
+        base = baseline['handlers'].get(name)
+        if base and stats['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {stats['p99_ms']:.1f}ms > baseline {base['p99_ms']:.1f}ms")
+    for name, stats in results['flows'].items():
+        base = baseline['flows'].get(name)
+        if base and stats['round_trips'] > base['round_trips']:
+            regressions.append(f"{name}: {stats['round_trips']} db round trips > baseline {base['round_trips']}")
+        if base and 'peak_kb' in base and stats['peak_kb'] > base['peak_kb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {stats['peak_kb']:.0f}KB > baseline {base['peak_kb']:.0f}KB")
+    return regressions
+
+
+def report(results):
+    print(f"{'query':<28}{'index used':>12}")
+    for name, used in sorted(results['indexes'].items()):
+        print(f"{name:<28}{'yes' if used else 'NO':>12}")
+    print()
+    print(f"{'handler':<28}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, stats in sorted(results['handlers'].items()):
+        print(f"{name:<28}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+    print()
+    print(f"{'flow':<28}{'round trips':>12}{'peak KB':>12}{'retained KB':>12}")
+    for name, stats in sorted(results['flows'].items()):
+        print(f"{name:<28}{stats['round_trips']:>12}{stats['peak_kb']:>12.1f}{stats['retained_kb']:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = run(args.iterations)
+    report(results)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    db.close_pool()
+    if args.compare:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+    elif not all(results['indexes'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
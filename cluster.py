@@ -0,0 +1,184 @@
+"""
+Multi-process deployment.
+
+The front process receives updates, by long polling or by webhook, and
+routes them to BOT_PROCESSES worker processes by hashing the chat id, so
+the conversation state of a chat always lives in the same worker. Workers
+keep their in-process caches (settings, free seats, schedule report,
+rosters) consistent by listening to the table changes other processes
+publish with Postgres NOTIFY.
+"""
+import multiprocessing
+import os
+import select
+import signal
+import threading
+import time
+
+from psycopg2 import DatabaseError, InterfaceError, OperationalError
+from telegram import Bot, Update
+from telegram.error import NetworkError
+
+import db
+import student_lists
+from availability import index as availability
+from config import (
+    BOT_TOKEN,
+    DATABASE_URL,
+    UPDATES_MODE,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL
+)
+from schedule_report import report
+from tools import logger
+from webhook import WebhookListener
+from workers import shard_for
+
+POLL_TIMEOUT = 30
+
+
+class ShardRouter:
+    """Queue-like object putting updates into the worker queue of their chat"""
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, update):
+        self.queues[shard_for(update, len(self.queues))].put(update.to_dict())
+
+    def qsize(self):
+        return max(updates.qsize() for updates in self.queues)
+
+
+def feed(updater, updates):
+    """Pass the updates routed to this worker to its dispatcher until None is received"""
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        updater.dispatcher.update_queue.put(Update.de_json(data, updater.bot))
+
+
+def apply_changes(tables):
+    """Drop the in-process state depending on the tables changed by another process"""
+    db.query_cache.invalidate(tables)
+    if tables & {'classes', 'schedule'}:
+        availability.mark_stale()
+    if tables & {'classes', 'schedule', 'users'}:
+        report.invalidate()
+    if 'users' in tables:
+        student_lists.invalidate()
+
+
+class ChangeListener:
+    """Thread listening to the table changes published by the other processes"""
+
+    def __init__(self):
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="change_listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+
+    def _listen(self):
+        conn = db.create_connection(DATABASE_URL)
+        if conn is None:
+            raise OperationalError("No db connection")
+        conn.autocommit = True
+        conn.cursor().execute("LISTEN {};".format(db.CHANGES_CHANNEL))
+        return conn
+
+    def _run(self):
+        own_pid = str(os.getpid())
+        conn = None
+        while self._running:
+            try:
+                if conn is None:
+                    conn = self._listen()
+                    # changes may have been missed while not listening
+                    apply_changes({'classes', 'schedule', 'users', 'settings'})
+                if select.select([conn], [], [], 1) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    pid, _, tables = notify.payload.partition(":")
+                    if pid != own_pid:
+                        apply_changes(set(tables.split(",")))
+            except (DatabaseError, InterfaceError, OperationalError) as e:
+                logger.error("Change listener failed: %s", e)
+                if conn is not None:
+                    conn.close()
+                conn = None
+                time.sleep(1)
+        if conn is not None:
+            conn.close()
+
+
+def poll(bot, router, stopped):
+    """Long poll Telegram and route the updates until stopped is set"""
+    offset = None
+    # skip the updates received while the bot was down, as start_polling(clean=True) does
+    pending = bot.get_updates(timeout=0)
+    if pending:
+        offset = pending[-1].update_id + 1
+    while not stopped.is_set():
+        try:
+            updates = bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+        except NetworkError as e:
+            logger.warning("Polling failed: %s", e)
+            time.sleep(1)
+            continue
+        for update in updates:
+            router.put(update)
+            offset = update.update_id + 1
+
+
+def _worker_main(run_worker, num, updates):
+    # workers are stopped by the front process through their queues
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run_worker(num, updates)
+
+
+def run_front(run_worker, processes):
+    """Start the worker processes and route the incoming updates to them
+
+    :param run_worker: callable(num, updates queue) running a worker
+    :param int processes: number of worker processes
+    """
+    queues = [multiprocessing.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(processes)]
+    workers = [multiprocessing.Process(target=_worker_main, args=(run_worker, num, updates), name=f"bot_worker_{num}")
+               for num, updates in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    router = ShardRouter(queues)
+    bot = Bot(BOT_TOKEN)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    logger.info("Started %s bot workers", processes)
+    try:
+        if UPDATES_MODE == 'webhook':
+            listener = WebhookListener(bot, router, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE)
+            listener.start(WEBHOOK_URL)
+            while not stopped.wait(1):
+                pass
+            listener.stop()
+        else:
+            poll(bot, router, stopped)
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for worker in workers:
+            worker.join()
@@ -8,6 +8,67 @@ CLASSES_HOURS = ["12:00", "14:00", "16:00", "18:00", "20:00"]
 
 DATABASE_URL = os.environ['DATABASE_URL']
 
+# 'disable' for a local db without ssl
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require')
+
+# db connection pool size
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', 1))
+DB_POOL_MAX_CONN = int(os.environ.get('DB_POOL_MAX_CONN', 10))
+# seconds to wait for a free pooled connection
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# connections idle for longer than this, seconds, are checked before use
+DB_POOL_IDLE_CHECK = float(os.environ.get('DB_POOL_IDLE_CHECK', 60))
+
+# bot worker processes, updates are routed to them by chat id when more than 1
+BOT_PROCESSES = int(os.environ.get('BOT_PROCESSES', 1))
+
+# concurrent updates processing, 0 workers means updates are handled one by one
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 100))
+
+# updates ingestion, 'polling' or 'webhook'
+UPDATES_MODE = os.environ.get('UPDATES_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # public base url the webhook is registered at
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', 8443))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 500))
+
+# small talk, DialogFlow url may point to a local stub server in tests
+SMALLTALK_URL = os.environ.get('SMALLTALK_URL', 'https://api.api.ai/v1')
+SMALLTALK_TOKEN = os.environ.get('SMALLTALK_TOKEN', 'e0f0ee1fd08b4160bdb26c69df632678')
+SMALLTALK_TIMEOUT = float(os.environ.get('SMALLTALK_TIMEOUT', 3))
+SMALLTALK_POOL_SIZE = int(os.environ.get('SMALLTALK_POOL_SIZE', 4))
+SMALLTALK_CACHE_SIZE = int(os.environ.get('SMALLTALK_CACHE_SIZE', 1000))
+
+# outbound messages limits, messages per second
+OUTBOX_GLOBAL_RATE = float(os.environ.get('OUTBOX_GLOBAL_RATE', 25))
+OUTBOX_CHAT_RATE = float(os.environ.get('OUTBOX_CHAT_RATE', 1))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 3))
+# seconds a handler waits for its reply to be sent
+OUTBOX_REPLY_TIMEOUT = float(os.environ.get('OUTBOX_REPLY_TIMEOUT', 30))
+
+# abandoned dialogs expiration, seconds
+SESSION_TIMEOUT = int(os.environ.get('SESSION_TIMEOUT', 60 * 60))
+SESSION_SWEEP_INTERVAL = int(os.environ.get('SESSION_SWEEP_INTERVAL', 5 * 60))
+
+# free seats index reload from the db, seconds
+AVAILABILITY_RECONCILE_INTERVAL = int(os.environ.get('AVAILABILITY_RECONCILE_INTERVAL', 10 * 60))
+
+# local Prometheus metrics endpoint port, 0 disables it.
+# Cluster workers use the consecutive ports starting from this one.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
+
+# daily class reminders send time, HH:MM of the bot local time
+REMINDER_TIME = os.environ.get('REMINDER_TIME', '18:00')
+
+# execute the hot queries as server-side prepared statements
+PREPARE_STATEMENTS = os.environ.get('PREPARE_STATEMENTS', 'yes') == 'yes'
+
+# select results cache, seconds and number of entries
+QUERY_CACHE_TTL = int(os.environ.get('QUERY_CACHE_TTL', 60))
+QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 512))
+
 DATE_FORMAT = "%Y-%m-%d"
 
 # Conversation states
@@ -26,6 +87,8 @@ LIST_OF_ADMINS = list(map(int, os.environ['ADMIN_IDS'].split(',')))
 
 PEOPLE_PER_TIME_SLOT = 9
 
+SUBSCRIPTIONS_PER_WEEK = 2
+
 PLACES = [
     "МГАК",
     "Мотокафе",
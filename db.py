@@ -1,9 +1,31 @@
+import datetime as dt
 import logging
-import psycopg2
-
-from psycopg2 import DatabaseError
+import os
+import re
+import threading
+import time as _time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 
-from config import DATABASE_URL
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import DatabaseError, InterfaceError, OperationalError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from config import (
+    BOT_PROCESSES,
+    DATABASE_URL,
+    DB_POOL_IDLE_CHECK,
+    DB_POOL_MAX_CONN,
+    DB_POOL_MIN_CONN,
+    DB_POOL_TIMEOUT,
+    DB_SSLMODE,
+    PEOPLE_PER_TIME_SLOT,
+    PREPARE_STATEMENTS,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    SUBSCRIPTIONS_PER_WEEK
+)
 
 
 create_users_table = """
@@ -45,9 +67,145 @@ CREATE TABLE IF NOT EXISTS settings (
 
 set_initial_settings = """
 INSERT INTO settings (param, value)
-VALUES ('allow', 'yes');
+VALUES ('allow', 'yes')
+ON CONFLICT (param) DO NOTHING;
+"""
+
+create_schema_migrations_table = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+ version integer PRIMARY KEY,
+ applied_at timestamp NOT NULL DEFAULT now()
+);
+"""
+
+lock_schema_migrations = """
+LOCK TABLE schema_migrations IN EXCLUSIVE MODE;
+"""
+
+get_applied_migrations_sql = """
+SELECT version FROM schema_migrations;
+"""
+
+add_applied_migration_sql = """
+INSERT INTO schema_migrations (version) VALUES (%s);
+"""
+
+remove_duplicate_subscriptions = """
+DELETE FROM schedule a USING schedule b
+WHERE a.ctid < b.ctid
+    AND a.user_id = b.user_id
+    AND a.class_id = b.class_id;
+"""
+
+add_schedule_primary_key = """
+ALTER TABLE schedule ADD PRIMARY KEY (user_id, class_id);
+"""
+
+create_schedule_class_id_index = """
+CREATE INDEX IF NOT EXISTS schedule_class_id_idx ON schedule (class_id);
+"""
+
+create_classes_date_place_open_index = """
+CREATE INDEX IF NOT EXISTS classes_date_place_open_idx ON classes (date, place, open);
+"""
+
+create_users_group_num_index = """
+CREATE INDEX IF NOT EXISTS users_group_num_idx ON users (group_num);
+"""
+
+create_user_visits_table = """
+CREATE TABLE IF NOT EXISTS user_visits (
+ user_id integer PRIMARY KEY,
+ visits integer NOT NULL,
+ FOREIGN KEY (user_id) REFERENCES users (id)
+);
+"""
+
+# user_visits holds the number of bookings for classes before the date stored in settings
+backfill_user_visits = """
+INSERT INTO settings (param, value)
+VALUES ('visits_counted_until', current_date::text)
+ON CONFLICT (param) DO UPDATE SET value = EXCLUDED.value;
+DELETE FROM user_visits;
+INSERT INTO user_visits (user_id, visits)
+SELECT sch.user_id, count(1)
+FROM schedule sch
+JOIN classes cl ON cl.id=sch.class_id
+WHERE cl.date < current_date
+GROUP BY sch.user_id;
+"""
+
+# Classes passed since the last refresh are added to the counters. Only upcoming
+# bookings may change, so the counted past never needs to be recounted.
+# Dates are stored as iso strings and compared as text not to cast other settings.
+refresh_user_visits_sql = """
+SELECT value FROM settings WHERE param = 'visits_counted_until' FOR UPDATE;
+WITH passed AS (
+    SELECT sch.user_id, count(1) AS visits
+    FROM schedule sch
+    JOIN classes cl ON cl.id=sch.class_id
+    WHERE cl.date >= (SELECT value FROM settings WHERE param = 'visits_counted_until')::date
+        AND cl.date < %(today)s
+    GROUP BY sch.user_id
+), counted AS (
+    INSERT INTO user_visits (user_id, visits)
+    SELECT user_id, visits FROM passed
+    ON CONFLICT (user_id) DO UPDATE SET visits = user_visits.visits + EXCLUDED.visits
+    RETURNING user_id
+)
+UPDATE settings SET value = %(today)s
+WHERE param = 'visits_counted_until' AND value < %(today)s
+RETURNING (SELECT count(*) FROM counted);
+"""
+
+get_user_visits_sql = """
+SELECT user_id, visits FROM user_visits WHERE user_id = ANY(%s);
 """
 
+create_user_data_table = """
+CREATE TABLE IF NOT EXISTS user_data (
+ user_id integer PRIMARY KEY,
+ data bytea NOT NULL
+);
+"""
+
+create_conversations_table = """
+CREATE TABLE IF NOT EXISTS conversations (
+ name text NOT NULL,
+ key text NOT NULL,
+ state integer NOT NULL,
+ PRIMARY KEY (name, key)
+);
+"""
+
+# Versioned schema changes, applied in order and exactly once.
+# Never edit an applied migration, add a new version instead.
+MIGRATIONS = [
+    (1, [
+        create_users_table,
+        create_classes_table,
+        create_schedule_table,
+        create_settings_table,
+        set_initial_settings,
+    ]),
+    (2, [
+        remove_duplicate_subscriptions,
+        # also serves lookups by schedule.user_id
+        add_schedule_primary_key,
+        create_schedule_class_id_index,
+        create_classes_date_place_open_index,
+        create_users_group_num_index,
+    ]),
+    (3, [
+        create_user_visits_table,
+        backfill_user_visits,
+    ]),
+    (4, [
+        create_user_data_table,
+        create_conversations_table,
+    ]),
+]
+
 set_settings_param_value = """
 UPDATE settings SET value = %s
 WHERE param = %s;
@@ -58,9 +216,17 @@ SELECT value from settings
 WHERE param = %s;
 """
 
-add_classes_dates_sql = """
-INSERT INTO classes (place, date, time, open)
-VALUES (%s,%s,%s,%s);
+add_classes_range_sql = """
+WITH created AS (
+    INSERT INTO classes (place, date, time, open)
+    SELECT place, day::date, time, true
+    FROM generate_series(%s::date, %s::date, interval '1 day') AS day,
+         unnest(%s::text[]) AS place,
+         unnest(%s::text[]) AS time
+    ON CONFLICT (place, date, time) DO NOTHING
+    RETURNING id
+)
+SELECT count(*) FROM created;
 """
 
 get_user_sql = """
@@ -99,110 +265,183 @@ WHERE
     id = %s;
 """
 
-update_user_last_name_sql = """
-UPDATE users
-SET last_name = %s
-WHERE
-    id = %s;
-"""
-
-get_open_classes_dates_sql = """
-SELECT date, count(*) from classes 
-WHERE date >= %s
-    AND open is true
-    AND place = %s
-GROUP BY date
-ORDER BY date;
-"""
-
-get_open_classes_time_sql = """
-SELECT time FROM classes WHERE date = %s AND place = %s AND open is true ORDER BY time;
+get_classes_occupancy_sql = """
+SELECT cl.place, cl.date, cl.time, count(sch.user_id)
+FROM classes cl
+LEFT JOIN schedule sch ON sch.class_id=cl.id
+WHERE cl.date >= %s
+GROUP BY cl.id, cl.place, cl.date, cl.time;
 """
 
-set_user_subscription_sql = """
-INSERT INTO schedule (user_id, class_id) VALUES (%s,%s);
+get_full_schedule_sql = """
+SELECT cl.place, cl.date, cl.time, us.group_num, us.last_name, us.id
+FROM classes cl
+JOIN schedule sch ON cl.id=sch.class_id
+JOIN users us ON us.id=sch.user_id
+WHERE cl.date>=%s
+ORDER BY cl.place, cl.date, cl.time;
 """
 
-get_class_id_sql = """
-SELECT id from classes WHERE date = %s AND time = %s AND place = %s;
+# Rows come already grouped by date and place and sorted by last name inside a group,
+# so the export is written while streaming.
+get_schedule_report_sql = """
+SELECT cl.date, cl.place, cl.time, us.group_num, us.last_name, 0
+FROM classes cl
+JOIN schedule sch ON cl.id=sch.class_id
+JOIN users us ON us.id=sch.user_id
+WHERE cl.date>=%(start)s
+ORDER BY cl.date, cl.place, COALESCE(us.last_name, '');
 """
 
-get_classes_ids_by_date_sql = """
-SELECT id from classes WHERE date = %s AND place = ANY(%s);
+get_schedule_for_date_sql = """
+SELECT cl.place, cl.time, us.id
+FROM classes cl
+JOIN schedule sch ON cl.id=sch.class_id
+JOIN users us ON us.id=sch.user_id
+WHERE cl.date=%s
+ORDER BY cl.place, cl.time;
 """
 
-get_classes_ids_by_date_time_sql = """
-SELECT id from classes WHERE date = %s AND time = %s AND place = ANY(%s);
+get_user_data_sql = """
+SELECT data FROM user_data WHERE user_id = %s;
 """
 
-get_full_schedule_sql = """
-SELECT cl.place, cl.date, cl.time, us.group_num, us.last_name, us.id
-FROM classes cl
-JOIN schedule sch ON cl.id=sch.class_id
-JOIN users us ON us.id=sch.user_id
-WHERE cl.date>=%s
-ORDER BY cl.place, cl.date, cl.time;
+upsert_user_data_sql = """
+INSERT INTO user_data (user_id, data) VALUES (%s, %s)
+ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data;
 """
 
-get_user_visits_count = """
-SELECT user_id, count(1)
-FROM schedule sch
-JOIN classes cl ON cl.id=sch.class_id
-WHERE cl.date<%s AND user_id = ANY(%s)
-GROUP BY user_id;
+delete_user_data_sql = """
+DELETE FROM user_data WHERE user_id = %s;
 """
 
-get_user_subscriptions_sql = """
-SELECT cl.place, cl.date, cl.time FROM schedule sch
-JOIN classes cl ON sch.class_id=cl.id
-WHERE sch.user_id = %s and cl.date >= %s;
+get_conversations_sql = """
+SELECT key, state FROM conversations WHERE name = %s;
 """
 
-get_user_subscriptions_for_date_sql = """
-SELECT cl.place, cl.date, cl.time FROM schedule sch
-JOIN classes cl ON sch.class_id=cl.id
-WHERE sch.user_id = %s and cl.date = %s;
+upsert_conversation_sql = """
+INSERT INTO conversations (name, key, state) VALUES (%s, %s, %s)
+ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state;
 """
 
-delete_user_subscription_sql = """
-DELETE FROM schedule WHERE user_id = %s AND class_id = %s;
+delete_conversation_sql = """
+DELETE FROM conversations WHERE name = %s AND key = %s;
 """
 
-get_people_count_per_time_slot_sql = """
-SELECT COUNT(*) FROM schedule sch
-JOIN classes cl ON sch.class_id=cl.id
-WHERE cl.date = %s AND cl.time = %s AND cl.place = %s;
+get_user_context_sql = """
+SELECT
+    (SELECT value FROM settings WHERE param = 'allow'),
+    COALESCE((
+        SELECT json_agg(json_build_array(cl.place, cl.date, cl.time) ORDER BY cl.date, cl.time)
+        FROM schedule sch
+        JOIN classes cl ON cl.id=sch.class_id
+        WHERE sch.user_id = %(user_id)s AND cl.date >= %(since)s
+    ), '[]'::json);
 """
 
-set_class_state = """
-UPDATE classes
-SET open = %s
+update_user_last_name_returning_sql = """
+UPDATE users
+SET last_name = %s
 WHERE
-    id = %s;
+    id = %s
+RETURNING last_name, group_num;
 """
 
-
-get_delete_schedules_for_classes_sql = """
-    DELETE FROM schedule WHERE class_id = ANY(%s);
+# Booking outcomes
+BOOKED = 'booked'
+CLASS_FULL = 'full'
+NO_CLASS = 'no_class'
+DATE_LIMIT = 'date_limit'
+WEEK_LIMIT = 'week_limit'
+UNBOOKED = 'unbooked'
+NOT_BOOKED = 'not_booked'
+
+# Both scripts are sent in a single round trip. The leading statements lock the
+# class (and the user) rows, so the counts in the following statement, which
+# gets a fresh snapshot, already see every concurrent booking of the slot.
+book_class_sql = """
+SELECT id FROM users WHERE id = %(user_id)s FOR UPDATE;
+SELECT id FROM classes WHERE date = %(date)s AND time = %(time)s AND place = %(place)s FOR UPDATE;
+WITH cls AS (
+    SELECT id FROM classes WHERE date = %(date)s AND time = %(time)s AND place = %(place)s
+), taken AS (
+    SELECT count(*) AS people FROM schedule WHERE class_id IN (SELECT id FROM cls)
+), status AS (
+    SELECT CASE
+        WHEN NOT EXISTS (SELECT 1 FROM cls) THEN 'no_class'
+        WHEN (SELECT people FROM taken) >= %(capacity)s THEN 'full'
+        WHEN %(check_limits)s AND EXISTS (
+            SELECT 1 FROM schedule sch
+            JOIN classes cl ON cl.id = sch.class_id
+            WHERE sch.user_id = %(user_id)s AND cl.date = %(date)s
+        ) THEN 'date_limit'
+        WHEN %(check_limits)s AND (
+            SELECT count(*) FROM schedule sch
+            JOIN classes cl ON cl.id = sch.class_id
+            WHERE sch.user_id = %(user_id)s AND cl.date >= %(week_start)s
+        ) >= %(week_limit)s THEN 'week_limit'
+        ELSE 'booked'
+    END AS outcome
+), ins AS (
+    INSERT INTO schedule (user_id, class_id)
+    SELECT %(user_id)s, id FROM cls WHERE (SELECT outcome FROM status) = 'booked'
+    RETURNING class_id
+), upd AS (
+    UPDATE classes
+    SET open = (SELECT people FROM taken) + 1 < %(capacity)s
+    WHERE id IN (SELECT class_id FROM ins)
+    RETURNING id
+)
+SELECT (SELECT outcome FROM status), (SELECT count(*) FROM upd);
 """
 
+unbook_class_sql = """
+SELECT id FROM classes WHERE date = %(date)s AND time = %(time)s AND place = %(place)s FOR UPDATE;
+WITH cls AS (
+    SELECT id FROM classes WHERE date = %(date)s AND time = %(time)s AND place = %(place)s
+), del AS (
+    DELETE FROM schedule
+    WHERE user_id = %(user_id)s AND class_id IN (SELECT id FROM cls)
+    RETURNING class_id
+), upd AS (
+    UPDATE classes
+    SET open = (SELECT count(*) FROM schedule WHERE class_id = classes.id)
+               - (SELECT count(*) FROM del) < %(capacity)s
+    WHERE id IN (SELECT class_id FROM del)
+    RETURNING id
+)
+SELECT CASE WHEN EXISTS (SELECT 1 FROM del) THEN 'unbooked' ELSE 'not_booked' END,
+       (SELECT count(*) FROM upd);
+"""
 
-get_delete_classes_sql = """
-    DELETE FROM classes WHERE id = ANY(%s);
+remove_classes_range_sql = """
+WITH cls AS (
+    SELECT id FROM classes
+    WHERE date BETWEEN %(start)s AND %(end)s
+        AND place = ANY(%(places)s)
+        AND (%(time)s::text IS NULL OR time = %(time)s)
+), removed_bookings AS (
+    DELETE FROM schedule WHERE class_id IN (SELECT id FROM cls)
+    RETURNING class_id
+), removed_classes AS (
+    DELETE FROM classes WHERE id IN (SELECT id FROM cls)
+    RETURNING id
+)
+SELECT (SELECT count(*) FROM removed_classes), (SELECT count(*) FROM removed_bookings);
 """
 
-get_latest_group_num = """
-    SELECT group_num
+get_group_nums_sql = """
+    SELECT DISTINCT group_num
     FROM users
     WHERE group_num IS NOT null
-    ORDER BY group_num DESC LIMIT 1;
+    ORDER BY group_num;
 """
 
 
 def create_connection(conn_string):
     """ create a database connection to a SQLite database """
     try:
-        conn = psycopg2.connect(conn_string, sslmode='require')
+        conn = psycopg2.connect(conn_string, sslmode=DB_SSLMODE)
         logging.debug("Db connection established.")
         return conn
     except DatabaseError as e:
@@ -210,31 +449,463 @@ def create_connection(conn_string):
     return None
 
 
-def execute_insert(sql, values):
-    """Execute given sql"""
-    conn = create_connection(DATABASE_URL)
-    with conn:
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection remembering the statements prepared in its session"""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = _time.monotonic()
+
+
+_query_observers = []
+
+
+def add_query_observer(observer):
+    """Register callable(sql, seconds, failed) called after every db round trip"""
+    _query_observers.append(observer)
+
+
+def remove_query_observer(observer):
+    _query_observers.remove(observer)
+
+
+@contextmanager
+def _observed(sql):
+    started = _time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if _query_observers:
+            elapsed = _time.perf_counter() - started
+            for observer in _query_observers:
+                observer(sql, elapsed, failed)
+
+
+# Statements the helpers run on their own, observed as separate round trips
+ping_sql = "SELECT 1;"
+prepare_sql = "PREPARE {} AS {};"
+commit_sql = "COMMIT;"
+rollback_sql = "ROLLBACK;"
+
+# Hot queries executed as named server-side prepared statements. A script of several
+# statements is prepared as one statement per each, named name_1, name_2... Queries run
+# rarely are not listed and run as is.
+PREPARED_STATEMENTS = {
+    sql: name for name, sql in [
+        ("get_user_context_sql", get_user_context_sql),
+        ("book_class_sql", book_class_sql),
+        ("unbook_class_sql", unbook_class_sql),
+        ("get_user_sql", get_user_sql),
+        ("get_users_sql", get_users_sql),
+        ("get_classes_occupancy_sql", get_classes_occupancy_sql),
+        ("get_group_nums_sql", get_group_nums_sql),
+        ("get_user_visits_sql", get_user_visits_sql),
+    ]
+}
+_unpreparable = set()
+_prepared_scripts = {}  # name -> (PREPARE script, EXECUTE script)
+_placeholder_regex = re.compile(r"%\((\w+)\)s|%s")
+
+
+def _to_positional(sql):
+    """Replace %s and %(name)s placeholders with $1, $2...
+
+    A named placeholder used several times gets the same number.
+    :return: the statement and the list of placeholders ordered by their numbers
+    """
+    placeholders = []
+
+    def number(match):
+        placeholder = match.group(0)
+        if placeholder == "%s" or placeholder not in placeholders:
+            placeholders.append(placeholder)
+            return "${}".format(len(placeholders))
+        return "${}".format(placeholders.index(placeholder) + 1)
+    return _placeholder_regex.sub(number, sql.strip().rstrip(";")), placeholders
+
+
+def _prepared_script(name, sql):
+    """Return the scripts preparing and executing all the sql statements in one round trip each"""
+    scripts = _prepared_scripts.get(name)
+    if scripts is None:
+        statements = [statement for statement in sql.split(";") if statement.strip()]
+        prepares, executes = [], []
+        for num, statement in enumerate(statements, start=1):
+            statement_name = name if len(statements) == 1 else "{}_{}".format(name, num)
+            positional, placeholders = _to_positional(statement)
+            prepares.append(prepare_sql.format(statement_name, positional))
+            if placeholders:
+                executes.append("EXECUTE {} ({});".format(statement_name, ", ".join(placeholders)))
+            else:
+                executes.append("EXECUTE {};".format(statement_name))
+        scripts = _prepared_scripts[name] = ("\n".join(prepares), "\n".join(executes))
+    return scripts
+
+
+def _execute(cur, sql, values):
+    """Execute the sql as prepared statements when it is registered for it
+
+    The statements are prepared on the first use in a connection session. If they can't
+    be prepared the sql is executed as is from then on. Must be the first statement
+    of the transaction, as a failed PREPARE rolls it back.
+    """
+    name = PREPARED_STATEMENTS.get(sql)
+    if not PREPARE_STATEMENTS or name is None or name in _unpreparable:
+        cur.execute(sql, values)
+        return
+    prepare, execute = _prepared_script(name, sql)
+    conn = cur.connection
+    if name not in conn.prepared:
         try:
-            c = conn.cursor()
-            c.execute(sql, values)
-            conn.commit()
-        except DatabaseError as e:
+            with _observed(prepare_sql):
+                cur.execute(prepare)
+        except psycopg2.ProgrammingError as e:
+            logging.warning("Statement %s can't be prepared: %s", name, e)
+            with _observed(rollback_sql):
+                conn.rollback()
+            _unpreparable.add(name)
+            cur.execute(sql, values)
+            return
+        conn.prepared.add(name)
+    cur.execute(execute, values)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises PoolError when exhausted, the semaphore makes checkout wait instead
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(DB_POOL_MIN_CONN, DB_POOL_MAX_CONN,
+                                               DATABASE_URL, sslmode=DB_SSLMODE,
+                                               connection_factory=PreparingConnection)
+                logging.debug("Db connection pool created.")
+    return _pool
+
+
+def close_pool():
+    """Close all the pooled connections"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def _is_alive(conn):
+    """Check that a pooled connection is still usable"""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur, _observed(ping_sql):
+            cur.execute(ping_sql)
+        with _observed(rollback_sql):
             conn.rollback()
-            logging.error("psycopg2 error: {}", e)
-            raise e
+        return True
+    except (OperationalError, InterfaceError):
+        return False
 
 
-def execute_select(sql, values=None):
+def _checkout():
+    """Take a healthy connection from the pool, waiting for a free one
+
+    Only the connections idle for longer than DB_POOL_IDLE_CHECK are checked,
+    broken ones are replaced until a healthy connection is found.
+    """
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise PoolError("No free db connection in {} seconds".format(DB_POOL_TIMEOUT))
+    try:
+        pool = get_pool()
+        # every idle connection may be broken, e.g. after a db restart
+        for _ in range(DB_POOL_MAX_CONN + 1):
+            conn = pool.getconn()
+            if _time.monotonic() - conn.last_used < DB_POOL_IDLE_CHECK or _is_alive(conn):
+                return conn
+            logging.warning("Discarding broken db connection.")
+            pool.putconn(conn, close=True)
+        raise OperationalError("No healthy db connection")
+    except Exception:
+        _pool_slots.release()
+        raise
+
+
+@contextmanager
+def get_connection():
+    """Context manager lending a pooled connection
+
+    Waits up to DB_POOL_TIMEOUT for a free connection when all of them are in use.
+    The transaction is committed on success and rolled back on error.
+    A connection that failed on the network level is dropped from the pool
+    so the next checkout reconnects.
+    """
+    pool = get_pool()
+    conn = _checkout()
+    broken = False
+    try:
+        yield conn
+        with _observed(commit_sql):
+            conn.commit()
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        if not conn.closed:
+            with _observed(rollback_sql):
+                conn.rollback()
+        raise
+    finally:
+        conn.last_used = _time.monotonic()
+        pool.putconn(conn, close=broken or bool(conn.closed))
+        _pool_slots.release()
+
+
+_written_table_regex = re.compile(r"\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)", flags=re.IGNORECASE)
+
+
+def written_tables(sql):
+    """Return the set of tables the given sql writes to"""
+    return {table.lower() for table in _written_table_regex.findall(sql)}
+
+
+class QueryCache:
+    """Read-through cache of select results
+
+    Entries are keyed by sql and its parameters and tagged with the tables
+    the query reads, so a write to a table evicts every dependent entry.
+    The cache is bounded both by entry age and by the number of entries.
+    Every invalidation bumps the generation of the tables, a result read
+    before a concurrent write is not stored as it was read at an older one.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, tables, rows)
+        self._generations = defaultdict(int)  # table -> number of invalidations
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(sql, values):
+        return sql, repr(values)
+
+    def generation(self, tables):
+        """Return the generation to pass to put() for a result read from now on"""
+        with self._lock:
+            return tuple(self._generations[table] for table in tables)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < _time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, tables, rows, generation):
+        """Store the rows unless any of the tables was invalidated since the generation was taken"""
+        with self._lock:
+            if tuple(self._generations[table] for table in tables) != generation:
+                return
+            self._entries[key] = (_time.monotonic() + self.ttl, frozenset(tables), rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        """Evict all the entries reading any of the given tables"""
+        tables = set(tables)
+        with self._lock:
+            for table in tables:
+                self._generations[table] += 1
+            stale = [key for key, entry in self._entries.items() if entry[1] & tables]
+            for key in stale:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+query_cache = QueryCache(QUERY_CACHE_TTL, QUERY_CACHE_SIZE)
+
+
+CHANGES_CHANNEL = 'table_changes'
+
+publish_changes_sql = """
+SELECT pg_notify(%s, %s);
+"""
+
+
+def publish_changes(cur, sql):
+    """Notify the other bot processes about the tables written by the sql
+
+    Runs in the writing transaction, so the notification is delivered on commit only.
+    The payload is 'pid:table1,table2'. Nothing is sent by a single process bot.
+    """
+    tables = written_tables(sql)
+    if BOT_PROCESSES > 1 and tables:
+        cur.execute(publish_changes_sql, (CHANGES_CHANNEL, "{}:{}".format(os.getpid(), ",".join(sorted(tables)))))
+
+
+def execute_insert(sql, values):
     """Execute given sql"""
-    conn = create_connection(DATABASE_URL)
-    with conn:
-        try:
-            cur = conn.cursor()
-            cur.execute(sql, values)
-            return cur.fetchall()
-        except DatabaseError as e:
-            logging.error("psycopg2 error: {}", e)
-            raise e
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as c, _observed(sql):
+                _execute(c, sql, values)
+                publish_changes(c, sql)
+    except DatabaseError as e:
+        logging.error("psycopg2 error: %s", e)
+        raise e
+    finally:
+        query_cache.invalidate(written_tables(sql))
+
+
+def execute_select(sql, values=None, cache_tables=None):
+    """Execute given sql
+
+    :param cache_tables: opt-in caching, the tables the query reads from.
+        The result is served from the query cache until one of them is written to.
+    """
+    if cache_tables:
+        key = query_cache.make_key(sql, values)
+        rows = query_cache.get(key)
+        if rows is not None:
+            return list(rows)
+        generation = query_cache.generation(cache_tables)
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur, _observed(sql):
+                _execute(cur, sql, values)
+                rows = cur.fetchall()
+    except DatabaseError as e:
+        logging.error("psycopg2 error: %s", e)
+        raise e
+    if cache_tables:
+        query_cache.put(key, cache_tables, tuple(rows), generation)
+    return rows
+
+
+def stream_select(sql, values=None, itersize=500):
+    """Execute given sql and yield the result rows using a server-side cursor
+
+    Rows are fetched from the server by itersize chunks, so memory use does not
+    grow with the result size. The connection is held until the generator is exhausted or closed.
+    """
+    try:
+        with get_connection() as conn:
+            with conn.cursor(name="stream_select") as cur:
+                cur.itersize = itersize
+                with _observed(sql):
+                    cur.execute(sql, values)
+                for row in cur:
+                    yield row
+    except DatabaseError as e:
+        logging.error("psycopg2 error: %s", e)
+        raise e
+
+
+def execute_returning(sql, values):
+    """Execute given modifying sql in one transaction and return its result rows"""
+    try:
+        with get_connection() as conn:
+            with conn.cursor() as cur, _observed(sql):
+                _execute(cur, sql, values)
+                rows = cur.fetchall()
+                publish_changes(cur, sql)
+                return rows
+    except DatabaseError as e:
+        logging.error("psycopg2 error: %s", e)
+        raise e
+    finally:
+        query_cache.invalidate(written_tables(sql))
+
+
+def book_class(user_id, place, date, time, week_start, check_limits=True):
+    """Book a seat for the user in one transaction and one round trip
+
+    Slot capacity is always enforced. The one-booking-per-date rule and
+    the weekly quota are enforced only when check_limits is set.
+    The class open state is updated along with the booking.
+    :return: one of BOOKED, CLASS_FULL, NO_CLASS, DATE_LIMIT, WEEK_LIMIT
+    """
+    values = {
+        'user_id': user_id,
+        'place': place,
+        'date': date,
+        'time': time,
+        'week_start': week_start,
+        'check_limits': check_limits,
+        'capacity': PEOPLE_PER_TIME_SLOT,
+        'week_limit': SUBSCRIPTIONS_PER_WEEK,
+    }
+    return execute_returning(book_class_sql, values)[0][0]
+
+
+def unbook_class(user_id, place, date, time):
+    """Remove the user booking and reopen the class in one round trip
+
+    :return: UNBOOKED or NOT_BOOKED if there was nothing to remove
+    """
+    values = {
+        'user_id': user_id,
+        'place': place,
+        'date': date,
+        'time': time,
+        'capacity': PEOPLE_PER_TIME_SLOT,
+    }
+    return execute_returning(unbook_class_sql, values)[0][0]
+
+
+def add_classes(start, end, places, hours):
+    """Create open classes for every day of the range, place and hour at once
+
+    Slots which already exist are left untouched.
+    :return: tuple (created, existing) slots count
+    """
+    created = execute_returning(add_classes_range_sql, (start, end, list(places), list(hours)))[0][0]
+    total = ((end - start).days + 1) * len(places) * len(hours)
+    return created, total - created
+
+
+def remove_classes(start, end, places, time=None):
+    """Remove classes with their bookings for the date range in one statement
+
+    :param time: is optional, if given only this time is removed
+    :return: tuple (removed classes, displaced bookings) count
+    """
+    values = {'start': start, 'end': end, 'places': list(places), 'time': time}
+    removed_classes, removed_bookings = execute_returning(remove_classes_range_sql, values)[0]
+    return removed_classes, removed_bookings
+
+
+def refresh_user_visits(today=None):
+    """Add the classes passed since the last refresh to the users visits counters"""
+    today = (today or dt.date.today()).isoformat()
+    execute_returning(refresh_user_visits_sql, {'today': today})
+
+
+def get_user_visits(user_ids):
+    """Return user_id -> visits count of past classes for the given users"""
+    refresh_user_visits()
+    return dict(execute_select(get_user_visits_sql, (list(user_ids),)))
 
 
 def upsert_user(user_id, nick_name, first_name, last_name):
@@ -246,18 +917,54 @@ def upsert_user(user_id, nick_name, first_name, last_name):
 
 
 def migrate(conn):
-    # create tables
-    sqls = [
-        create_users_table,
-        create_classes_table,
-        create_schedule_table,
-        create_settings_table,
-        set_initial_settings,
-    ]
+    """Apply the migrations which are not applied yet
+
+    Every version is applied in its own transaction and recorded
+    in schema_migrations.
+    :return: list of applied versions
+    """
     c = conn.cursor()
-    for sql in sqls:
-        c.execute(sql)
+    c.execute(create_schema_migrations_table)
     conn.commit()
+    applied = []
+    for version, sqls in MIGRATIONS:
+        # the lock serializes concurrent migrate runs
+        c.execute(lock_schema_migrations)
+        c.execute(get_applied_migrations_sql)
+        if version in {row[0] for row in c.fetchall()}:
+            conn.rollback()
+            continue
+        try:
+            for sql in sqls:
+                c.execute(sql)
+            c.execute(add_applied_migration_sql, (version,))
+            conn.commit()
+        except DatabaseError as e:
+            conn.rollback()
+            logging.error("Migration %s failed: %s", version, e)
+            raise e
+        logging.info("Migration %s applied.", version)
+        applied.append(version)
+    return applied
+
+
+def explain(sql, values=None, seqscan=True):
+    """Return the query plan lines of the given select
+
+    :param bool seqscan: when False sequential scans are disabled for the query,
+        so a fitting index is used regardless of the tables size
+    """
+    prefix = "" if seqscan else "SET LOCAL enable_seqscan = off; "
+    return [row[0] for row in execute_select(prefix + "EXPLAIN " + sql, values)]
+
+
+def uses_index(sql, values, index_name, seqscan=True):
+    """Check that the planner uses the given index for the select
+
+    With seqscan the tables should hold enough rows for the planner
+    to prefer an index over a sequential scan.
+    """
+    return any(index_name in line for line in explain(sql, values, seqscan))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,237 @@
+"""
+Booking rush load generator and capacity correctness checker.
+
+Simulates N students starting the subscribe conversation at once right
+after booking is opened, each one trying several bookings, with a recording
+fake bot standing in for Telegram. Their updates go through the dispatcher
+update queue, so they are handled by the bot handlers, persistence and
+UPDATE_WORKERS concurrent workers the same way as in production. Reports
+throughput and conversation latency percentiles and then checks in the db
+that no slot exceeds PEOPLE_PER_TIME_SLOT, that the per-date and weekly
+limits held and that classes.open matches the real occupancy.
+
+Usage:
+    DB_SSLMODE=disable DATABASE_URL=postgres://localhost/bench_db BOT_TOKEN=x ADMIN_IDS=1 \\
+        python3 loadtest.py [--students 200] [--attempts 3] [--spread]
+
+Don't point it to production, the load test users bookings are wiped first.
+"""
+import argparse
+import datetime as dt
+import itertools
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+import db
+from benchmark import FakeBot, percentile, prepare_db
+from config import (
+    DB_POOL_MAX_CONN,
+    PEOPLE_PER_TIME_SLOT,
+    SUBSCRIPTIONS_PER_WEEK,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_WORKERS
+)
+from time_chart_bot import build_updater, stop_services
+from tools import start_of_the_week
+from webhook import start_dispatcher
+from workers import run_concurrently
+
+FIRST_STUDENT_ID = 800000
+
+# seconds a student waits for the bot reply
+REPLY_TIMEOUT = 30
+
+delete_students_bookings_sql = """
+DELETE FROM schedule WHERE user_id BETWEEN %s AND %s;
+"""
+
+reset_classes_state_sql = """
+UPDATE classes cl
+SET open = (SELECT count(*) FROM schedule WHERE class_id = cl.id) < %s
+WHERE cl.date > %s;
+"""
+
+over_capacity_sql = """
+SELECT cl.place, cl.date, cl.time, count(*)
+FROM schedule sch
+JOIN classes cl ON cl.id=sch.class_id
+WHERE cl.date > %s
+GROUP BY cl.id, cl.place, cl.date, cl.time
+HAVING count(*) > %s;
+"""
+
+several_per_date_sql = """
+SELECT sch.user_id, cl.date, count(*)
+FROM schedule sch
+JOIN classes cl ON cl.id=sch.class_id
+WHERE sch.user_id BETWEEN %s AND %s
+GROUP BY sch.user_id, cl.date
+HAVING count(*) > 1;
+"""
+
+over_weekly_limit_sql = """
+SELECT sch.user_id, count(*)
+FROM schedule sch
+JOIN classes cl ON cl.id=sch.class_id
+WHERE sch.user_id BETWEEN %s AND %s AND cl.date >= %s
+GROUP BY sch.user_id
+HAVING count(*) > %s;
+"""
+
+wrong_open_state_sql = """
+SELECT cl.place, cl.date, cl.time, cl.open, count(sch.user_id)
+FROM classes cl
+LEFT JOIN schedule sch ON sch.class_id=cl.id
+WHERE cl.date > %s
+GROUP BY cl.id, cl.place, cl.date, cl.time, cl.open
+HAVING cl.open <> (count(sch.user_id) < %s);
+"""
+
+
+class ChatBot(FakeBot):
+    """FakeBot letting the students wait for its replies"""
+
+    def __init__(self):
+        super(ChatBot, self).__init__()
+        self._replied = threading.Condition()
+        self._sent = defaultdict(int)
+
+    def send_message(self, chat_id, text, **kwargs):
+        result = FakeBot.__getattr__(self, 'send_message')(chat_id=chat_id, text=text, **kwargs)
+        with self._replied:
+            self._sent[chat_id] += 1
+            self._replied.notify_all()
+        return result
+
+    def sent_count(self, chat_id):
+        with self._replied:
+            return self._sent[chat_id]
+
+    def wait_reply(self, chat_id, sent, timeout):
+        """Wait for a message to the chat after the given number of sent ones
+
+        :return: False on timeout
+        """
+        with self._replied:
+            return self._replied.wait_for(lambda: self._sent[chat_id] > sent, timeout)
+
+
+_update_ids = itertools.count(1)
+
+
+def make_update(bot, user_id, text):
+    """Build a private chat text update as Telegram sends it"""
+    return Update.de_json({
+        'update_id': next(_update_ids),
+        'message': {
+            'message_id': next(_update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'first_name': "Bench", 'last_name': str(user_id), 'is_bot': False},
+            'text': text,
+        },
+    }, bot)
+
+
+def offered(bot, chat_id):
+    """Return texts of the buttons of the last keyboard sent to the chat"""
+    for name, args, kwargs in reversed(bot.calls):
+        if name == 'send_message' and kwargs.get('chat_id') == chat_id:
+            markup = kwargs.get('reply_markup')
+            keyboard = getattr(markup, 'keyboard', None)
+            if not keyboard:
+                return []
+            return [row[0].text for row in keyboard if row[0].text != "Отмена"]
+    return []
+
+
+def student(update_queue, bot, user_id, attempts, spread, stats, lock):
+    """Run the subscribe conversation attempts times as a student would
+
+    Every message is sent after the bot answered the previous one.
+    """
+    for _ in range(attempts):
+        started = time.perf_counter()
+        text = "Запиши меня"
+        while text:
+            sent = bot.sent_count(user_id)
+            update_queue.put(make_update(bot, user_id, text))
+            if not bot.wait_reply(user_id, sent, REPLY_TIMEOUT):
+                with lock:
+                    stats['timeouts'] += 1
+                return
+            choices = offered(bot, user_id)
+            text = (random.choice(choices) if spread else choices[0]) if choices else None
+        with lock:
+            stats['latencies'].append(time.perf_counter() - started)
+
+
+def check(first_id, last_id):
+    """Return list of the violated booking rules"""
+    today = dt.date.today().isoformat()
+    problems = []
+    for row in db.execute_select(over_capacity_sql, (today, PEOPLE_PER_TIME_SLOT)):
+        problems.append("slot {} {} {} has {} people".format(*row))
+    for row in db.execute_select(several_per_date_sql, (first_id, last_id)):
+        problems.append("student {} has {} bookings on {}".format(row[0], row[2], row[1]))
+    for row in db.execute_select(over_weekly_limit_sql, (first_id, last_id, start_of_the_week().isoformat(),
+                                                         SUBSCRIPTIONS_PER_WEEK)):
+        problems.append("student {} has {} bookings this week".format(*row))
+    for row in db.execute_select(wrong_open_state_sql, (today, PEOPLE_PER_TIME_SLOT)):
+        problems.append("slot {} {} {} open={} with {} people".format(*row))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--attempts', type=int, default=SUBSCRIPTIONS_PER_WEEK + 1)
+    parser.add_argument('--spread', action='store_true', help="pick random options instead of the first ones")
+    args = parser.parse_args()
+
+    first_id, last_id = FIRST_STUDENT_ID, FIRST_STUDENT_ID + args.students - 1
+    prepare_db(args.students, first_id)
+    db.execute_insert(delete_students_bookings_sql, (first_id, last_id))
+    db.execute_insert(reset_classes_state_sql, (PEOPLE_PER_TIME_SLOT, dt.date.today().isoformat()))
+
+    bot = ChatBot()
+    updater = build_updater()
+    updater.dispatcher.bot = bot
+    executor = run_concurrently(updater.dispatcher, UPDATE_WORKERS, UPDATE_QUEUE_SIZE) if UPDATE_WORKERS else None
+    start_dispatcher(updater)
+
+    stats, lock = {'latencies': [], 'timeouts': 0}, threading.Lock()
+    threads = [threading.Thread(target=student, args=(updater.update_queue, bot, user_id, args.attempts,
+                                                      args.spread, stats, lock))
+               for user_id in range(first_id, last_id + 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = stats['latencies']
+    print(f"{len(latencies)} conversations in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} per second "
+          f"(update workers: {UPDATE_WORKERS}, db connections: {DB_POOL_MAX_CONN})")
+    if latencies:
+        print(f"conversation latency p50 {percentile(latencies, 0.5) * 1000:.1f}ms "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    if stats['timeouts']:
+        print(f"{stats['timeouts']} students got no reply in {REPLY_TIMEOUT}s")
+    problems = check(first_id, last_id)
+    for problem in problems:
+        print("VIOLATION " + problem)
+    stop_services(updater, executor)
+    if problems or stats['timeouts']:
+        sys.exit(1)
+    print("All booking limits held.")
+
+
+if __name__ == '__main__':
+    main()
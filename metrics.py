@@ -0,0 +1,189 @@
+"""
+Per-handler and per-query metrics in Prometheus text format.
+
+Every dispatcher handler callback and every db round trip is timed.
+Handlers are labelled by the callback name, queries by the name of the
+SQL constant in db.py. The number of db round trips made while handling
+an update is recorded per handler too. Metrics are served on
+http://<host>:METRICS_PORT/metrics.
+"""
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler
+
+from telegram.ext import ConversationHandler
+
+import db
+from tools import logger
+from webhook import ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+class Histogram:
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            for num, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[num] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        for label_value, series in items:
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines.extend(f'{self.name}{{{self.label}="{key}"}} {value}' for key, value in items)
+        return lines
+
+
+handler_latency = Histogram("bot_handler_latency_seconds", "Handler callback latency.", "handler", LATENCY_BUCKETS)
+handler_errors = Counter("bot_handler_errors_total", "Handler callbacks failed with an exception.", "handler")
+handler_round_trips = Histogram("bot_handler_db_round_trips", "Db round trips per handled update.", "handler",
+                                ROUND_TRIP_BUCKETS)
+query_latency = Histogram("bot_db_query_latency_seconds", "Db query latency.", "query", LATENCY_BUCKETS)
+query_errors = Counter("bot_db_query_errors_total", "Failed db queries.", "query")
+
+_gauges = []  # (name, help, callable)
+_local = threading.local()
+_query_names = {}
+
+
+def register_gauge(name, help, value):
+    """Expose the value returned by the callable as a gauge"""
+    _gauges.append((name, help, value))
+
+
+def query_name(sql):
+    """Return the name of the db.py constant holding the sql"""
+    if not _query_names:
+        _query_names.update({value: name for name, value in vars(db).items()
+                             if isinstance(value, str) and not name.startswith("_")})
+    return _query_names.get(sql, "other")
+
+
+def observe_query(sql, seconds, failed):
+    name = query_name(sql)
+    query_latency.observe(name, seconds)
+    if failed:
+        query_errors.inc(name)
+    _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+
+
+def instrumented(callback):
+    """Wrap a handler callback to record its latency, errors and db round trips"""
+    name = getattr(callback, '__name__', repr(callback))
+
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        _local.round_trips = 0
+        started = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_latency.observe(name, time.perf_counter() - started)
+            handler_round_trips.observe(name, _local.round_trips)
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for inner in handler.entry_points + handler.fallbacks:
+            _instrument_handler(inner)
+        for state_handlers in handler.states.values():
+            for inner in state_handlers:
+                _instrument_handler(inner)
+    elif hasattr(handler, 'callback'):
+        handler.callback = instrumented(handler.callback)
+
+
+def instrument_dispatcher(dispatcher):
+    """Instrument all the registered handlers and the db queries"""
+    for group_handlers in dispatcher.handlers.values():
+        for handler in group_handlers:
+            _instrument_handler(handler)
+    db.add_query_observer(observe_query)
+
+
+def expose():
+    lines = []
+    for metric in (handler_latency, handler_errors, handler_round_trips, query_latency, query_errors):
+        lines.extend(metric.expose())
+    for name, help, value in _gauges:
+        try:
+            current = value()
+        except Exception as e:
+            logger.warning("Gauge %s failed: %s", name, e)
+            continue
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {current}"])
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, listen="127.0.0.1"):
+    """Serve the metrics in background"""
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics served on %s:%s", listen, port)
+    return server
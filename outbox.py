@@ -0,0 +1,252 @@
+"""
+Rate-limited outbound messages delivery.
+
+Messages are sent by a single sender thread from a priority queue while
+respecting Telegram limits: a token bucket per chat and a global one.
+Interactive replies go ahead of bulk traffic. When Telegram answers with
+RetryAfter the sending is paused for the given time and the message is
+queued again.
+
+The bot used by the handlers is an OutboxBot, so their replies go through
+the outbox too and share the limits with the bulk messages.
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from telegram import Bot
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from config import (
+    BOT_PROCESSES,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_REPLY_TIMEOUT
+)
+from tools import logger
+
+# priorities, lower goes first
+INTERACTIVE, BULK = 0, 1
+
+# seconds between drops of the idle per chat buckets
+EVICT_INTERVAL = 60
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # below 1 message per second the bucket must still hold a whole token
+        self.capacity = max(1, capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Return seconds to wait until a token is available"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        """A full bucket is the same as a new one and may be dropped"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outbox:
+
+    def __init__(self, global_rate, chat_rate, max_attempts):
+        self.chat_rate = chat_rate
+        self.max_attempts = max_attempts
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._paused_until = 0
+        self._evicted_at = time.monotonic()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1000)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def send(self, method, chat_id, priority=INTERACTIVE, **kwargs):
+        """Queue a bot method call, e.g. send(bot.send_message, chat_id, BULK, text="...")
+
+        :return: Future resolved with the method result
+        """
+        future = Future()
+        with self._cond:
+            heapq.heappush(self._heap, (priority, next(self._seq), time.monotonic(), 1,
+                                        method, chat_id, kwargs, future))
+            self._cond.notify()
+        return future
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self):
+        with self._cond:
+            latencies = sorted(self._latencies)
+            depth = len(self._heap)
+        stats = {'queue_depth': depth, 'sent': self.sent, 'failed': self.failed}
+        if latencies:
+            stats['latency_p50'] = latencies[len(latencies) // 2]
+            stats['latency_p99'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return stats
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket(self.chat_rate)
+        return self._chats[chat_id]
+
+    def _evict_idle(self, now):
+        """Drop the buckets of the chats which have not been sent to lately"""
+        if now - self._evicted_at < EVICT_INTERVAL:
+            return
+        self._evicted_at = now
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.is_full(now)]:
+            del self._chats[chat_id]
+
+    def _next_item(self, now):
+        """Pop the most urgent item which may be sent now, or return the time to wait"""
+        wait = max(self._paused_until - now, self._global.delay(now))
+        if wait > 0:
+            return None, wait
+        for item in sorted(self._heap):
+            chat_wait = self._chat_bucket(item[5]).delay(now)
+            if chat_wait <= 0:
+                self._heap.remove(item)
+                heapq.heapify(self._heap)
+                return item, 0
+            wait = chat_wait if wait <= 0 else min(wait, chat_wait)
+        return None, wait or None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._running:
+                        return
+                    if self._heap:
+                        item, wait = self._next_item(time.monotonic())
+                        if item:
+                            break
+                    else:
+                        wait = None
+                    self._cond.wait(wait)
+                now = time.monotonic()
+                self._global.consume(now)
+                self._chat_bucket(item[5]).consume(now)
+                self._evict_idle(now)
+            self._deliver(item)
+
+    def _deliver(self, item):
+        priority, seq, enqueued, attempt, method, chat_id, kwargs, future = item
+        if future.cancelled():
+            # the waiting handler gave up
+            return
+        try:
+            result = method(chat_id=chat_id, **kwargs)
+        except RetryAfter as e:
+            logger.warning("Outbox paused for %s seconds", e.retry_after)
+            with self._cond:
+                self._paused_until = time.monotonic() + e.retry_after
+                heapq.heappush(self._heap, item)
+            return
+        except (TimedOut, NetworkError) as e:
+            if attempt < self.max_attempts:
+                with self._cond:
+                    heapq.heappush(self._heap, (priority, seq, enqueued, attempt + 1,
+                                                method, chat_id, kwargs, future))
+                return
+            self._fail(future, e)
+            return
+        except Exception as e:
+            self._fail(future, e)
+            return
+        with self._cond:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - enqueued)
+        if not future.cancelled():
+            future.set_result(result)
+
+    def _fail(self, future, error):
+        logger.error("Outbox message failed: %s", error)
+        with self._cond:
+            self.failed += 1
+        if not future.cancelled():
+            future.set_exception(error)
+
+
+# every cluster worker sends, the global limit is shared between them.
+# Per chat limits hold as a chat is always served by the same worker.
+outbox = Outbox(OUTBOX_GLOBAL_RATE / BOT_PROCESSES, OUTBOX_CHAT_RATE, OUTBOX_MAX_ATTEMPTS)
+
+
+class OutboxBot(Bot):
+    """Bot sending the handlers replies through the outbox
+
+    Replies are queued with the interactive priority and the handler waits
+    for the delivery, so it gets the sent message or the error as before.
+    A reply not sent in OUTBOX_REPLY_TIMEOUT is dropped and TimedOut is raised,
+    so the update worker is not held forever.
+    """
+
+    @staticmethod
+    def _wait(future):
+        try:
+            return future.result(OUTBOX_REPLY_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimedOut()
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._wait(outbox.send(self.deliver_message, chat_id, text=text, **kwargs))
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._wait(outbox.send(self._deliver_document, chat_id, document=document, **kwargs))
+
+    def edit_message_text(self, text, chat_id=None, **kwargs):
+        if chat_id is None:
+            # inline messages are not bound to a chat
+            return super(OutboxBot, self).edit_message_text(text, **kwargs)
+        return self._wait(outbox.send(self._deliver_edit, chat_id, text=text, **kwargs))
+
+    def deliver_message(self, chat_id, text, **kwargs):
+        """Send the message right away, the outbox calls it when the limits allow"""
+        return super(OutboxBot, self).send_message(chat_id, text, **kwargs)
+
+    def _deliver_document(self, chat_id, document, **kwargs):
+        if hasattr(document, 'seek'):
+            # the file is read again when the sending is retried
+            document.seek(0)
+        return super(OutboxBot, self).send_document(chat_id, document, **kwargs)
+
+    def _deliver_edit(self, chat_id, text, **kwargs):
+        return super(OutboxBot, self).edit_message_text(text, chat_id=chat_id, **kwargs)
@@ -0,0 +1,101 @@
+"""
+Postgres backed persistence of user_data and conversation states.
+
+Only changed entries are written: every user_data entry and conversation
+state is compared against the last stored one. user_data is loaded lazily
+on the first access to a user. Conversation states are loaded once per
+conversation handler as they only hold the users in the middle of a dialog.
+A cluster worker loads only the conversations of the chats routed to it.
+"""
+import json
+import pickle
+from collections import defaultdict
+
+from psycopg2 import Binary
+from telegram.ext import BasePersistence
+
+import db
+from workers import shard_of
+
+
+class LazyUserData(defaultdict):
+    """user_data mapping loading a user entry from the db on first access"""
+
+    def __init__(self, persistence):
+        super(LazyUserData, self).__init__(dict)
+        self._persistence = persistence
+
+    def __missing__(self, user_id):
+        self[user_id] = self._persistence.load_user_data(user_id)
+        return self[user_id]
+
+
+class PostgresPersistence(BasePersistence):
+
+    def __init__(self, shard=0, shards=1):
+        """
+        :param int shard: the cluster worker number
+        :param int shards: the number of cluster workers
+        """
+        super(PostgresPersistence, self).__init__(store_user_data=True, store_chat_data=False)
+        self.shard = shard
+        self.shards = shards
+        self._user_data = None
+        self._stored_user_data = {}  # user_id -> pickled data as stored
+        self._conversations = {}  # name -> {key: state} as stored
+
+    def load_user_data(self, user_id):
+        rows = db.execute_select(db.get_user_data_sql, (user_id,))
+        if not rows:
+            return {}
+        blob = bytes(rows[0][0])
+        self._stored_user_data[user_id] = blob
+        return pickle.loads(blob)
+
+    def get_user_data(self):
+        if self._user_data is None:
+            self._user_data = LazyUserData(self)
+        return self._user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            rows = db.execute_select(db.get_conversations_sql, (name,))
+            conversations = {tuple(json.loads(key)): state for key, state in rows}
+            # keys start with the chat id, the conversations of other chats belong to other workers
+            self._conversations[name] = {key: state for key, state in conversations.items()
+                                         if shard_of(key[0], self.shards) == self.shard}
+        return dict(self._conversations[name])
+
+    def update_conversation(self, name, key, new_state):
+        stored = self._conversations.setdefault(name, {})
+        if stored.get(key) == new_state:
+            return
+        db_key = json.dumps(list(key))
+        if new_state is None:
+            db.execute_insert(db.delete_conversation_sql, (name, db_key))
+            stored.pop(key, None)
+        else:
+            db.execute_insert(db.upsert_conversation_sql, (name, db_key, new_state))
+            stored[key] = new_state
+
+    def update_user_data(self, user_id, data):
+        blob = pickle.dumps(data)
+        if self._stored_user_data.get(user_id, pickle.dumps({})) == blob:
+            return
+        db.execute_insert(db.upsert_user_data_sql, (user_id, Binary(blob)))
+        self._stored_user_data[user_id] = blob
+
+    def drop_user_data(self, user_id):
+        """Delete the stored user data and forget it until the user shows up again"""
+        if self._stored_user_data.pop(user_id, None) is not None:
+            db.execute_insert(db.delete_user_data_sql, (user_id,))
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def flush(self):
+        # every change is written right away
+        pass
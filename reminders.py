@@ -0,0 +1,32 @@
+"""
+Daily reminders about tomorrow classes.
+
+The job runs on the updater job queue, off the interactive path. Tomorrow
+bookings are read with one streaming query and every reminder goes through
+the rate-limited outbox as bulk traffic.
+"""
+import datetime as dt
+
+import db
+import outbox
+from config import REMINDER_TIME, WEEKDAYS
+from tools import logger
+
+
+def send_reminders(bot, job):
+    """Job callback sending a reminder to every student booked for tomorrow"""
+    tomorrow = dt.date.today() + dt.timedelta(days=1)
+    day = WEEKDAYS[tomorrow.weekday()]
+    count = 0
+    for place, time, user_id in db.stream_select(db.get_schedule_for_date_sql, (tomorrow.isoformat(),)):
+        outbox.outbox.send(bot.deliver_message, user_id, outbox.BULK,
+                           text=f"Напоминаю, завтра ({day}, {tomorrow}) занятие на {place} в {time}. "
+                                f"Если не получается прийти, напиши \"Отпиши меня\".")
+        count += 1
+    logger.info("Queued %s reminders for %s", count, tomorrow)
+
+
+def schedule_reminders(job_queue):
+    """Register the daily reminders job"""
+    send_time = dt.datetime.strptime(REMINDER_TIME, "%H:%M").time()
+    return job_queue.run_daily(send_reminders, send_time, name="class_reminders")
@@ -0,0 +1,136 @@
+"""
+Incrementally maintained upcoming schedule report.
+
+The report holds upcoming bookings grouped by (date, place), the same way
+the /schedule export lays them out. It is loaded from the db once and then
+updated by the handlers changing bookings, so serving /schedule only
+serializes already grouped data.
+"""
+import datetime as dt
+import threading
+
+import db
+from config import DATE_FORMAT
+
+
+def _to_date(date):
+    if isinstance(date, str):
+        return dt.datetime.strptime(date, DATE_FORMAT).date()
+    return date
+
+
+class ScheduleReport:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        # (date, place) -> {(user_id, time)}, admins may book a student several times a date
+        self._groups = {}
+        # user_id -> (group_num, last_name)
+        self._users = {}
+
+    def _load(self):
+        groups, users = {}, {}
+        rows = db.stream_select(db.get_full_schedule_sql, (dt.date.today().isoformat(),))
+        for place, date, time, group_num, last_name, user_id in rows:
+            groups.setdefault((date, place), set()).add((user_id, time))
+            users[user_id] = (group_num, last_name)
+        self._groups, self._users = groups, users
+        self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._load()
+
+    def _drop_past(self):
+        today = dt.date.today()
+        for key in [key for key in self._groups if key[0] < today]:
+            del self._groups[key]
+
+    def _user(self, user_id):
+        if user_id not in self._users:
+            user = db.execute_select(db.get_user_sql, (user_id,))
+            self._users[user_id] = (user[0][4], user[0][3]) if user else (None, None)
+        return self._users[user_id]
+
+    def invalidate(self):
+        """Drop the report, it is reloaded from the db on next use"""
+        with self._lock:
+            self._loaded = False
+            self._groups, self._users = {}, {}
+
+    def add_booking(self, user_id, place, date, time):
+        with self._lock:
+            if not self._loaded:
+                return
+            user_id = int(user_id)
+            self._user(user_id)
+            self._groups.setdefault((_to_date(date), place), set()).add((user_id, time))
+
+    def remove_booking(self, user_id, place, date, time):
+        with self._lock:
+            user_id = int(user_id)
+            key = (_to_date(date), place)
+            group = self._groups.get(key)
+            if group and (user_id, time) in group:
+                group.remove((user_id, time))
+                if not group:
+                    del self._groups[key]
+
+    def remove_classes(self, start, end, places, time=None):
+        with self._lock:
+            start, end = _to_date(start), _to_date(end)
+            for key in list(self._groups):
+                date, place = key
+                if not (start <= date <= end and place in places):
+                    continue
+                if time is None:
+                    del self._groups[key]
+                else:
+                    group = self._groups[key]
+                    group.difference_update([entry for entry in group if entry[1] == time])
+                    if not group:
+                        del self._groups[key]
+
+    def update_user(self, user_id, group_num=None, last_name=None):
+        with self._lock:
+            user_id = int(user_id)
+            if user_id not in self._users:
+                return
+            old_group_num, old_last_name = self._users[user_id]
+            self._users[user_id] = (group_num if group_num is not None else old_group_num,
+                                    last_name if last_name is not None else old_last_name)
+
+    def user_changed(self, user_id):
+        """Forget the user record, it is reloaded from the db on next use"""
+        with self._lock:
+            self._users.pop(int(user_id), None)
+
+    def rows(self, visits=None):
+        """Return report rows grouped by date and place, sorted by last name inside a group
+
+        :param dict visits: optional user_id -> visits count mapping
+        :return: list of (date, place, time, group_num, last_name, visits) tuples
+        """
+        visits = visits or {}
+        with self._lock:
+            self._ensure_loaded()
+            self._drop_past()
+            rows = []
+            for date, place in sorted(self._groups):
+                records = []
+                for user_id, time in self._groups[(date, place)]:
+                    group_num, last_name = self._user(user_id)
+                    records.append((date, place, time, group_num, last_name, visits.get(user_id, 0)))
+                records.sort(key=lambda x: (x[4] or '', x[2]))
+                rows.extend(records)
+            return rows
+
+    def user_ids(self):
+        with self._lock:
+            self._ensure_loaded()
+            self._drop_past()
+            return {user_id for group in self._groups.values() for user_id, time in group}
+
+
+report = ScheduleReport()
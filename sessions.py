@@ -0,0 +1,98 @@
+"""
+Expiration of abandoned dialogs.
+
+Conversations end after SESSION_TIMEOUT of inactivity by the ConversationHandler
+conversation_timeout. Their TIMEOUT state handler clears the user_data scratch
+entries (place, date, student_id, start/end...).
+
+PTB schedules the timeout only when a conversation gets an update, so the
+conversations restored from persistence after a restart would never expire,
+and the scratch entries left by the dialogs ended normally are never cleared.
+A periodic sweeper ends the conversations and evicts the user_data of the
+users idle for longer than the timeout, so memory stays bounded when people
+walk away mid-dialog.
+"""
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+from config import SESSION_SWEEP_INTERVAL, SESSION_TIMEOUT
+from tools import logger
+
+
+def _drop_user_data(dispatcher, user_id):
+    dispatcher.user_data.pop(user_id, None)
+    persistence = dispatcher.persistence
+    if persistence and persistence.store_user_data:
+        persistence.drop_user_data(user_id)
+
+
+def timeout_handlers(dispatcher):
+    """Return the ConversationHandler.TIMEOUT state handlers dropping the user data"""
+
+    def clear_user_data(bot, update):
+        user = update.effective_user
+        if user is None:
+            return
+        _drop_user_data(dispatcher, user.id)
+        logger.debug("Conversation of user %s expired.", user.id)
+
+    return [TypeHandler(Update, clear_user_data)]
+
+
+class SessionSweeper:
+
+    def __init__(self, dispatcher, conversation_handlers, timeout):
+        self.dispatcher = dispatcher
+        self.conversation_handlers = conversation_handlers
+        self.timeout = timeout
+        self._last_seen = {}  # user_id -> monotonic time of the last update
+        self._lock = threading.Lock()
+
+    def touch(self, bot, update):
+        """Handler callback marking the update user as active"""
+        if update.effective_user is not None:
+            with self._lock:
+                self._last_seen[update.effective_user.id] = time.monotonic()
+
+    def _is_idle(self, user_id, now):
+        # users restored from persistence are given the full timeout
+        return now - self._last_seen.setdefault(user_id, now) > self.timeout
+
+    def sweep(self, bot, job):
+        """Job callback ending idle conversations and evicting idle users data"""
+        now = time.monotonic()
+        ended = 0
+        with self._lock:
+            for handler in self.conversation_handlers:
+                for key in list(handler.conversations):
+                    if self._is_idle(key[-1], now):
+                        timeout_job = handler.timeout_jobs.pop(key, None)
+                        if timeout_job is not None:
+                            timeout_job.schedule_removal()
+                        handler.update_state(ConversationHandler.END, key)
+                        ended += 1
+            idle_users = [user_id for user_id in list(self.dispatcher.user_data) if self._is_idle(user_id, now)]
+            for user_id in idle_users:
+                _drop_user_data(self.dispatcher, user_id)
+            for user_id in [user_id for user_id in self._last_seen if self._is_idle(user_id, now)]:
+                del self._last_seen[user_id]
+        if ended or idle_users:
+            logger.info("Expired %s conversations and %s users data", ended, len(idle_users))
+
+    def live_conversations(self):
+        """Gauge of conversations in progress"""
+        return sum(len(handler.conversations) for handler in self.conversation_handlers)
+
+
+def expire_sessions(dispatcher, conversation_handlers):
+    """Register the activity tracker and the periodic sweeper
+
+    :return: the SessionSweeper
+    """
+    sweeper = SessionSweeper(dispatcher, conversation_handlers, SESSION_TIMEOUT)
+    dispatcher.add_handler(TypeHandler(Update, sweeper.touch), group=-1)
+    dispatcher.job_queue.run_repeating(sweeper.sweep, SESSION_SWEEP_INTERVAL, name="session_sweeper")
+    return sweeper
@@ -0,0 +1,166 @@
+"""
+Small talk answers for free text messages.
+
+Common phrases are answered by a local matcher, other ones are passed to
+DialogFlow. Remote answers are cached by the normalized phrase. Requests reuse
+pooled keep-alive connections. The socket timeout bounds the connect and every
+read separately, so a watchdog shuts the socket down once a request takes
+SMALLTALK_TIMEOUT in total, a slow NLP service doesn't hold an update worker longer.
+"""
+import http.client
+import json
+import queue
+import re
+import socket
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from config import (
+    SMALLTALK_CACHE_SIZE,
+    SMALLTALK_POOL_SIZE,
+    SMALLTALK_TIMEOUT,
+    SMALLTALK_TOKEN,
+    SMALLTALK_URL
+)
+from tools import logger
+
+LOCAL_ANSWERS = {
+    "привет": "Привет!",
+    "здравствуй": "Привет!",
+    "здравствуйте": "Здравствуйте!",
+    "добрый день": "Добрый!",
+    "спасибо": "Пожалуйста!",
+    "спасибо большое": "Пожалуйста!",
+    "пока": "Пока!",
+    "как дела": "Отлично! Записываю людей на занятия.",
+    "ты кто": "Я MD-помошник. Записываю на занятия. Напиши \"запиши меня\".",
+}
+
+_non_word_regex = re.compile(r"[^\w\s]+")
+_spaces_regex = re.compile(r"\s+")
+
+
+def normalize(phrase):
+    """Lower case the phrase and drop punctuation and extra spaces"""
+    phrase = _non_word_regex.sub(" ", phrase.lower().replace("ё", "е"))
+    return _spaces_regex.sub(" ", phrase).strip()
+
+
+class LRUCache:
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class DialogFlowClient:
+    """DialogFlow v1 query API client with pooled keep-alive connections"""
+
+    def __init__(self, url, token, timeout, pool_size):
+        parts = urlsplit(url)
+        self._connection_class = (http.client.HTTPSConnection if parts.scheme == "https"
+                                  else http.client.HTTPConnection)
+        self._netloc = parts.netloc
+        self._path = (parts.path.rstrip("/") or "") + "/query?v=20150910"
+        self._token = token
+        self._timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connection_class(self._netloc, timeout=self._timeout)
+
+    def _put_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @staticmethod
+    def _abort(conn, aborted):
+        """Watchdog callback interrupting the request blocked on the socket"""
+        aborted.set()
+        sock = conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def query(self, text, session_id):
+        """Return the speech answer for the text or None on any failure"""
+        body = json.dumps({"query": text, "lang": "ru", "sessionId": session_id})
+        headers = {
+            "Authorization": "Bearer " + self._token,
+            "Content-Type": "application/json; charset=utf-8",
+        }
+        conn = self._get_connection()
+        aborted = threading.Event()
+        watchdog = threading.Timer(self._timeout, self._abort, args=(conn, aborted))
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            conn.request("POST", self._path, body=body.encode("utf-8"), headers=headers)
+            if aborted.is_set():
+                # the deadline passed while connecting, there was no socket to shut down yet
+                raise socket.timeout("deadline exceeded")
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            logger.warning("Small talk request failed: %s", e)
+            return None
+        finally:
+            watchdog.cancel()
+            watchdog.join()
+        if aborted.is_set():
+            conn.close()
+            logger.warning("Small talk request took longer than %s seconds", self._timeout)
+            return None
+        self._put_connection(conn)
+        if response.status != 200:
+            logger.warning("Small talk request failed with status %s", response.status)
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))["result"]["fulfillment"]["speech"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("Bad small talk response: %s", e)
+            return None
+
+
+_client = DialogFlowClient(SMALLTALK_URL, SMALLTALK_TOKEN, SMALLTALK_TIMEOUT, SMALLTALK_POOL_SIZE)
+_cache = LRUCache(SMALLTALK_CACHE_SIZE)
+
+
+def reply(text, session_id="MotoChatAIBot"):
+    """Return the answer to the phrase or None if there is no answer"""
+    phrase = normalize(text)
+    if not phrase:
+        return None
+    if phrase in LOCAL_ANSWERS:
+        return LOCAL_ANSWERS[phrase]
+    answer = _cache.get(phrase)
+    if answer is None:
+        answer = _client.query(text, session_id)
+        if answer is None:
+            return None
+        _cache.put(phrase, answer)
+    return answer
@@ -1,55 +1,172 @@
 """
 Base methods for user_list keyboard creation and processing.
+
+Group rosters are cached by group number and the neighbouring groups are
+prefetched in background, so paging the keyboard doesn't wait for the db.
+The cache is invalidated when users change their group or last name.
 """
 
 import db
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from itertools import zip_longest
 from math import ceil
 
+from psycopg2 import Error as DBError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from tools import logger
+
 
 COMPONENT = 'users'
 
+# students per keyboard page, two per row, Telegram allows up to 100 buttons
+PAGE_SIZE = 40
+
+_lock = threading.Lock()
+_group_nums = None
+_rosters = {}
+# bumped by invalidate(), results loaded before that are not cached
+_generation = 0
+
+_prefetcher = ThreadPoolExecutor(max_workers=1)
+_prefetching = set()
+
+
+def invalidate():
+    """Drop the cached rosters, call it when a user group or name is changed"""
+    global _group_nums, _generation
+    with _lock:
+        _group_nums = None
+        _rosters.clear()
+        _generation += 1
+
+
+def group_nums():
+    """Return sorted list of the non empty group numbers"""
+    global _group_nums
+    with _lock:
+        if _group_nums is not None:
+            return _group_nums
+        generation = _generation
+    nums = [row[0] for row in db.execute_select(db.get_group_nums_sql)]
+    with _lock:
+        if generation == _generation:
+            _group_nums = nums
+    return nums
+
+
+def roster(group_num):
+    """Return list of (id, last_name) of the group students"""
+    with _lock:
+        if group_num in _rosters:
+            return _rosters[group_num]
+        generation = _generation
+    students = db.execute_select(db.get_users_sql, (group_num,))
+    with _lock:
+        if generation == _generation:
+            _rosters[group_num] = students
+    return students
+
+
+def neighbour_group(group_num, step):
+    """Return the nearest existing group number in the step direction or None"""
+    nums = group_nums()
+    candidates = [num for num in nums if (num - group_num) * step > 0]
+    if not candidates:
+        return None
+    return min(candidates) if step > 0 else max(candidates)
+
+
+def _prefetch(group_num):
+    try:
+        for step in (-1, 1):
+            num = neighbour_group(group_num, step)
+            if num is not None:
+                roster(num)
+    except DBError as e:
+        logger.warning("Rosters prefetch failed: %s", e)
+    finally:
+        with _lock:
+            _prefetching.discard(group_num)
+
 
-def create_callback_data(action, group_num, user_id):
+def prefetch_neighbours(group_num):
+    """Load the neighbouring groups rosters in background
+
+    A single background thread does it, a group already waiting for the prefetch is not queued again.
+    """
+    with _lock:
+        if group_num in _prefetching:
+            return
+        _prefetching.add(group_num)
+    _prefetcher.submit(_prefetch, group_num)
+
+
+def create_callback_data(action, group_num, user_id, page=0):
     """ Create the callback data associated to each button"""
-    return ";".join([COMPONENT, action, str(group_num), str(user_id)])
+    return ";".join([COMPONENT, action, str(group_num), str(user_id), str(page)])
 
 
 def separate_callback_data(data):
-    """ Separate the callback data"""
-    return data.split(";")[1:]
+    """ Separate the callback data
+
+    Buttons sent before the paging was added have no page, the first page is assumed.
+    """
+    fields = data.split(";")[1:]
+    if len(fields) == 3:
+        fields.append("0")
+    return fields
+
+
+def _pages_count(students):
+    return max(1, ceil(len(students)/PAGE_SIZE))
 
 
-def user_kbd(group_num=None):
+def user_kbd(group_num=None, page=0):
     """
     Create an inline keyboard with the people list of the given group num
     :param int group_num: group number to use for kbd creation, if None the latest group num is used.
+    :param int page: page of the group list for the large groups
     :return: Returns the InlineKeyboardMarkup object with the people list.
     """
     if group_num is None:
-        group_num = db.execute_select(db.get_latest_group_num)[0][0]
-    students = db.execute_select(db.get_users_sql, (group_num,))
+        nums = group_nums()
+        group_num = nums[-1] if nums else 0
+    students = roster(group_num)
+    prefetch_neighbours(group_num)
+    pages = _pages_count(students)
+    page = min(max(page, 0), pages - 1)
+    students = students[page*PAGE_SIZE:(page+1)*PAGE_SIZE]
     rows_num = ceil(len(students)/2)
     stud_pairs = zip_longest(students[:rows_num], students[rows_num:])
     keyboard = []
     # First row - group num
-    data_ignore = create_callback_data("IGNORE", group_num, -1)
-    data_cancel = create_callback_data("CANCEL", group_num, -1)
+    data_ignore = create_callback_data("IGNORE", group_num, -1, page)
+    data_cancel = create_callback_data("CANCEL", group_num, -1, page)
     row = []
-    row.append(InlineKeyboardButton(f"Группа {group_num}", callback_data=data_ignore))
+    title = f"Группа {group_num}" if pages == 1 else f"Группа {group_num} ({page + 1}/{pages})"
+    row.append(InlineKeyboardButton(title, callback_data=data_ignore))
     keyboard.append(row)
     # Main rows
     for pair in stud_pairs:
         row = []
         row.append(InlineKeyboardButton(
             text=pair[0][1] or pair[0][0],  # last name or id
-            callback_data=create_callback_data("STUDENT", group_num, pair[0][0])))
+            callback_data=create_callback_data("STUDENT", group_num, pair[0][0], page)))
         if pair[1]:
             row.append(InlineKeyboardButton(
                 text=pair[1][1] or pair[1][0],  # last name or id
-                callback_data=create_callback_data("STUDENT", group_num, pair[1][0])))
+                callback_data=create_callback_data("STUDENT", group_num, pair[1][0], page)))
+        keyboard.append(row)
+    # Pages row, there is no way back from the first page and further from the last one
+    if pages > 1:
+        row = []
+        if page > 0:
+            row.append(InlineKeyboardButton("«", callback_data=create_callback_data("PREV-PAGE", group_num, -1, page)))
+        row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=data_ignore))
+        if page < pages - 1:
+            row.append(InlineKeyboardButton("»", callback_data=create_callback_data("NEXT-PAGE", group_num, -1, page)))
         keyboard.append(row)
     # Last row - Buttons
     row = []
@@ -71,7 +188,8 @@ def process_user_selection(bot, update):
     """
     ret_data = (False, None)
     query = update.callback_query
-    (action, group_num, user_id) = separate_callback_data(query.data)
+    (action, group_num, user_id, page) = separate_callback_data(query.data)
+    group_num, page = int(group_num), int(page)
     if action == "IGNORE":
         bot.answer_callback_query(callback_query_id=query.id)
     elif action == "CANCEL":
@@ -83,16 +201,25 @@ def process_user_selection(bot, update):
                               chat_id=query.message.chat_id,
                               message_id=query.message.message_id)
         ret_data = True, user_id
-    elif action == "PREV-GROUP":
-        bot.edit_message_text(text=query.message.text,
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id,
-                              reply_markup=user_kbd(int(group_num)-1))
-    elif action == "NEXT-GROUP":
-        bot.edit_message_text(text=query.message.text,
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id,
-                              reply_markup=user_kbd(int(group_num)+1))
+    elif action in ("PREV-PAGE", "NEXT-PAGE"):
+        new_page = page + (1 if action == "NEXT-PAGE" else -1)
+        # keyboards sent before the group shrank may still point out of it
+        if not 0 <= new_page < _pages_count(roster(group_num)):
+            bot.answer_callback_query(callback_query_id=query.id, text="Больше страниц нет.")
+        else:
+            bot.edit_message_text(text=query.message.text,
+                                  chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id,
+                                  reply_markup=user_kbd(group_num, new_page))
+    elif action in ("PREV-GROUP", "NEXT-GROUP"):
+        new_group_num = neighbour_group(group_num, 1 if action == "NEXT-GROUP" else -1)
+        if new_group_num is None:
+            bot.answer_callback_query(callback_query_id=query.id, text="Больше групп нет.")
+        else:
+            bot.edit_message_text(text=query.message.text,
+                                  chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id,
+                                  reply_markup=user_kbd(new_group_num))
     else:
         bot.answer_callback_query(callback_query_id=query.id, text="Something went wrong!")
         # UNKNOWN
@@ -9,12 +9,16 @@ Base methods for calendar keyboard creation and processing.
 
 import calendar
 import datetime
+from functools import lru_cache
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 
 COMPONENT = 'calendar'
 
+# number of month keyboards kept
+CACHE_SIZE = 24
+
 
 def create_callback_data(action, year, month, day):
     """ Create the callback data associated to each button"""
@@ -26,6 +30,19 @@ def separate_callback_data(data):
     return data.split(";")[1:]
 
 
+_cache_date = None
+
+
+def _check_rollover():
+    """Drop the cached keyboards when the date changes"""
+    global _cache_date
+    today = datetime.date.today()
+    if today != _cache_date:
+        _build_calendar.cache_clear()
+        _cache_date = today
+    return today
+
+
 def create_calendar(year=None, month=None):
     """
     Create an inline keyboard with the provided year and month
@@ -33,11 +50,17 @@ def create_calendar(year=None, month=None):
     :param int month: Month to use in the calendar, if None the current month is used.
     :return: Returns the InlineKeyboardMarkup object with the calendar.
     """
-    now = datetime.datetime.now()
+    today = _check_rollover()
     if year is None:
-        year = now.year
+        year = today.year
     if month is None:
-        month = now.month
+        month = today.month
+    return _build_calendar(year, month)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _build_calendar(year, month):
+    """Build the month keyboard, the result is shared between calls and must not be changed"""
     data_ignore = create_callback_data("IGNORE", year, month, 0)
     data_cancel = create_callback_data("CANCEL", year, month, 0)
     keyboard = []
@@ -70,6 +93,47 @@ def create_calendar(year=None, month=None):
     return InlineKeyboardMarkup(keyboard)
 
 
+def _ignore(bot, query, year, month, day):
+    bot.answer_callback_query(callback_query_id=query.id)
+
+
+def _cancel(bot, query, year, month, day):
+    bot.edit_message_text(text="Отменил",
+                          chat_id=query.message.chat_id,
+                          message_id=query.message.message_id)
+
+
+def _select_day(bot, query, year, month, day):
+    bot.edit_message_text(text=query.message.text,
+                          chat_id=query.message.chat_id,
+                          message_id=query.message.message_id)
+    return True, datetime.datetime(year, month, day)
+
+
+def _show_month(bot, query, year, month):
+    bot.edit_message_text(text=query.message.text,
+                          chat_id=query.message.chat_id,
+                          message_id=query.message.message_id,
+                          reply_markup=create_calendar(year, month))
+
+
+def _prev_month(bot, query, year, month, day):
+    _show_month(bot, query, *((year, month - 1) if month > 1 else (year - 1, 12)))
+
+
+def _next_month(bot, query, year, month, day):
+    _show_month(bot, query, *((year, month + 1) if month < 12 else (year + 1, 1)))
+
+
+ACTIONS = {
+    "IGNORE": _ignore,
+    "CANCEL": _cancel,
+    "DAY": _select_day,
+    "PREV-MONTH": _prev_month,
+    "NEXT-MONTH": _next_month,
+}
+
+
 def process_calendar_selection(bot, update):
     """
     Process the callback_query. This method generates a new calendar if forward or
@@ -79,34 +143,10 @@ def process_calendar_selection(bot, update):
     :return: Returns a tuple (Boolean,datetime.datetime), indicating if a date is selected
                 and returning the date if so.
     """
-    ret_data = (False, None)
     query = update.callback_query
     (action, year, month, day) = separate_callback_data(query.data)
-    curr = datetime.datetime(int(year), int(month), 1)
-    if action == "IGNORE":
-        bot.answer_callback_query(callback_query_id=query.id)
-    elif action == "CANCEL":
-        bot.edit_message_text(text="Отменил",
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id)
-    elif action == "DAY":
-        bot.edit_message_text(text=query.message.text,
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id)
-        ret_data = True, datetime.datetime(int(year), int(month), int(day))
-    elif action == "PREV-MONTH":
-        pre = curr - datetime.timedelta(days=1)
-        bot.edit_message_text(text=query.message.text,
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id,
-                              reply_markup=create_calendar(int(pre.year), int(pre.month)))
-    elif action == "NEXT-MONTH":
-        ne = curr + datetime.timedelta(days=31)
-        bot.edit_message_text(text=query.message.text,
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id,
-                              reply_markup=create_calendar(int(ne.year), int(ne.month)))
-    else:
+    handler = ACTIONS.get(action)
+    if handler is None:
         bot.answer_callback_query(callback_query_id=query.id, text="Something went wrong!")
-        # UNKNOWN
-    return ret_data
+        return False, None
+    return handler(bot, query, int(year), int(month), int(day)) or (False, None)
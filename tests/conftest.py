@@ -0,0 +1,9 @@
+import os
+import sys
+
+# config reads these on import, nothing connects to them in the tests
+os.environ.setdefault('BOT_TOKEN', '123456:TEST-TOKEN')
+os.environ.setdefault('DATABASE_URL', 'postgres://localhost/test_db')
+os.environ.setdefault('ADMIN_IDS', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
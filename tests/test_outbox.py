@@ -0,0 +1,19 @@
+from outbox import Outbox, TokenBucket
+
+
+def test_bucket_below_one_message_per_second_releases_tokens():
+    bucket = TokenBucket(0.5)
+    now = bucket.updated
+    assert bucket.delay(now) == 0
+    bucket.consume(now)
+    assert bucket.delay(now) == 2
+    assert bucket.delay(now + 2) == 0
+
+
+def test_cancelled_message_is_not_sent():
+    outbox = Outbox(25, 0.5, 3)
+    sent = []
+    future = outbox.send(lambda chat_id, **kwargs: sent.append(chat_id), 42)
+    future.cancel()
+    outbox._deliver(outbox._heap.pop())
+    assert sent == []
@@ -0,0 +1,18 @@
+import pickle
+
+import db
+from persistence import PostgresPersistence
+
+
+def test_dropped_user_data_row_is_deleted(monkeypatch):
+    writes = []
+    monkeypatch.setattr(db, 'execute_select',
+                        lambda sql, values=None: [(pickle.dumps({'place': "A"}),)] if values == (1,) else [])
+    monkeypatch.setattr(db, 'execute_insert', lambda sql, values: writes.append((sql, values)))
+    persistence = PostgresPersistence()
+    user_data = persistence.get_user_data()
+    assert user_data[1] == {'place': "A"}
+    assert user_data[2] == {}
+    persistence.drop_user_data(1)
+    persistence.drop_user_data(2)
+    assert writes == [(db.delete_user_data_sql, (1,))]
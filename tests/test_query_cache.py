@@ -0,0 +1,50 @@
+import db
+
+
+class FakeConnection:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return self
+
+    def fetchall(self):
+        return [(1,)]
+
+
+def test_write_evicts_dependent_entries():
+    cache = db.QueryCache(ttl=60, max_size=10)
+    cache.put("a", ("schedule",), ("row",), cache.generation(("schedule",)))
+    cache.put("b", ("users",), ("row",), cache.generation(("users",)))
+    cache.invalidate(db.written_tables(db.unbook_class_sql))
+    assert cache.get("a") is None
+    assert cache.get("b") == ("row",)
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+
+def test_result_read_before_a_write_is_not_stored():
+    cache = db.QueryCache(ttl=60, max_size=10)
+    generation = cache.generation(("settings",))
+    cache.invalidate({"settings"})
+    cache.put("a", ("settings",), ("stale",), generation)
+    assert cache.get("a") is None
+
+
+def test_select_is_served_from_cache_until_written(monkeypatch):
+    queries = []
+
+    def query(cur, sql, values):
+        queries.append(sql)
+    monkeypatch.setattr(db, 'get_connection', FakeConnection)
+    monkeypatch.setattr(db, '_execute', query)
+    monkeypatch.setattr(db, 'query_cache', db.QueryCache(ttl=60, max_size=10))
+    for _ in range(2):
+        assert db.execute_select(db.get_user_context_sql, {'user_id': 1}, cache_tables=("settings",)) == [(1,)]
+    db.execute_insert(db.set_settings_param_value, ("no", "allow"))
+    db.execute_select(db.get_user_context_sql, {'user_id': 1}, cache_tables=("settings",))
+    assert queries == [db.get_user_context_sql, db.set_settings_param_value, db.get_user_context_sql]
+
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from telegram.ext import ConversationHandler
+
+import sessions
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_sweeper(monkeypatch, conversations, user_data):
+    clock = Clock()
+    monkeypatch.setattr(sessions.time, 'monotonic', clock)
+    handler = ConversationHandler(entry_points=[], states={}, fallbacks=[])
+    handler.conversations = conversations
+    dispatcher = SimpleNamespace(user_data=user_data, persistence=None)
+    return sessions.SessionSweeper(dispatcher, [handler], timeout=60), handler, clock
+
+
+def test_restored_conversation_expires(monkeypatch):
+    sweeper, handler, clock = make_sweeper(monkeypatch, {(42, 42): 1}, {42: {'place': "A"}})
+    sweeper.sweep(None, None)
+    assert handler.conversations == {(42, 42): 1}
+    clock.now += 61
+    sweeper.sweep(None, None)
+    assert handler.conversations == {}
+    assert sweeper.dispatcher.user_data == {}
+
+
+def test_active_user_is_kept(monkeypatch):
+    sweeper, handler, clock = make_sweeper(monkeypatch, {(42, 42): 1}, {42: {'place': "A"}, 7: {'date': "2019-01-01"}})
+    sweeper.sweep(None, None)
+    clock.now += 61
+    sweeper.touch(None, SimpleNamespace(effective_user=SimpleNamespace(id=42)))
+    sweeper.sweep(None, None)
+    assert handler.conversations == {(42, 42): 1}
+    assert sweeper.dispatcher.user_data == {42: {'place': "A"}}
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import student_lists
+
+
+class RecordingBot:
+
+    def __init__(self):
+        self.calls = []
+
+    def answer_callback_query(self, **kwargs):
+        self.calls.append(('answer_callback_query', kwargs))
+
+    def edit_message_text(self, **kwargs):
+        self.calls.append(('edit_message_text', kwargs))
+
+
+def page_buttons(markup):
+    return [button.text for button in markup.inline_keyboard[-2]]
+
+
+def press(bot, data):
+    query = SimpleNamespace(id="1", data=data, message=SimpleNamespace(chat_id=1, message_id=2, text="Кого?"))
+    return student_lists.process_user_selection(bot, SimpleNamespace(callback_query=query))
+
+
+def test_page_buttons_are_hidden_at_the_ends(monkeypatch):
+    students = [(num, f"Student{num}") for num in range(student_lists.PAGE_SIZE + 1)]
+    monkeypatch.setattr(student_lists, 'roster', lambda group_num: students)
+    monkeypatch.setattr(student_lists, 'prefetch_neighbours', lambda group_num: None)
+    assert page_buttons(student_lists.user_kbd(1, 0)) == ["1/2", "»"]
+    assert page_buttons(student_lists.user_kbd(1, 1)) == ["«", "2/2"]
+
+
+def test_paging_past_the_last_page_is_answered(monkeypatch):
+    monkeypatch.setattr(student_lists, 'roster', lambda group_num: [(1, "Student")])
+    monkeypatch.setattr(student_lists, 'prefetch_neighbours', lambda group_num: None)
+    bot = RecordingBot()
+    press(bot, student_lists.create_callback_data("NEXT-PAGE", 1, -1, 0))
+    assert bot.calls == [('answer_callback_query', {'callback_query_id': "1", 'text': "Больше страниц нет."})]
@@ -0,0 +1,53 @@
+from telegram import Update
+
+import db
+import smalltalk
+import time_chart_bot
+
+
+class RecordingBot:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def text_update(bot, text, chat_id=42):
+    return Update.de_json({
+        'update_id': 1,
+        'message': {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'first_name': 'Test', 'is_bot': False},
+            'text': text,
+        },
+    }, bot)
+
+
+def dispatch(monkeypatch, text):
+    # no persisted conversations or user data
+    monkeypatch.setattr(db, 'execute_select', lambda sql, values=None: [])
+    monkeypatch.setattr(db, 'execute_insert', lambda sql, values: None)
+    dispatcher = time_chart_bot.build_updater().dispatcher
+    bot = RecordingBot()
+    dispatcher.bot = bot
+    dispatcher.process_update(text_update(bot, text))
+    return bot.sent
+
+
+def test_plain_text_is_answered_by_small_talk(monkeypatch):
+    assert dispatch(monkeypatch, "Привет!") == [(42, "Привет!")]
+
+
+def test_unknown_phrase_is_passed_to_dialogflow(monkeypatch):
+    queries = []
+
+    def query(text, session_id):
+        queries.append(text)
+        return "Погода отличная"
+    monkeypatch.setattr(smalltalk._client, 'query', query)
+    assert dispatch(monkeypatch, "Какая погода?") == [(42, "Погода отличная")]
+    assert queries == ["Какая погода?"]
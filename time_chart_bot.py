@@ -22,9 +22,9 @@ Conversation:
  Then follow it's instructions.
 """
 # TODO: Try pendulum https://github.com/sdispater/pendulum
-import json
+import signal
+import threading
 
-import apiai
 from telegram import ReplyKeyboardRemove
 from telegram.ext import (
     CallbackQueryHandler,
@@ -32,12 +32,16 @@ from telegram.ext import (
     ConversationHandler,
     Filters,
     MessageHandler,
-    PicklePersistence,
     RegexHandler,
     Updater
 )
+from telegram.utils.request import Request
 
+import cluster
 import db
+import metrics
+import smalltalk
+from availability import start_availability
 from admin_handlers import (
     add,
     add_schedule_continue,
@@ -55,10 +59,24 @@ from config import (
     ASK_PLACE_STATE,
     ASK_TIME_STATE,
     BOT_TOKEN,
-    DATABASE_URL,
+    BOT_PROCESSES,
+    METRICS_PORT,
     REMOVE_SCHEDULE_STATE,
-    RETURN_UNSUBSCRIBE_STATE
+    RETURN_UNSUBSCRIBE_STATE,
+    SESSION_TIMEOUT,
+    UPDATE_QUEUE_SIZE,
+    UPDATE_WORKERS,
+    UPDATES_MODE,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL
 )
+from outbox import OutboxBot, outbox
+from persistence import PostgresPersistence
+from reminders import schedule_reminders
+from sessions import expire_sessions, timeout_handlers
 from tools import logger
 from user_handlers import (
     ask_date,
@@ -71,27 +89,25 @@ from user_handlers import (
     store_sign_up,
     unsubscribe
 )
-
-conn = db.create_connection(DATABASE_URL)
+from webhook import start_dispatcher, start_webhook
+from workers import run_concurrently
 
 
 def error(bot, update, error):
     """Log Errors caused by Updates."""
-    bot.send_message(chat_id=update.message.chat_id, text="Произошла какая-то ошибка. Попробуй еще раз.")
     logger.warning('Update "%s" caused error "%s"', update, error)
+    # callback queries have no message of the user to answer
+    chat = update.effective_chat if update else None
+    if chat:
+        bot.send_message(chat_id=chat.id, text="Произошла какая-то ошибка. Попробуй еще раз.")
 
 
 def text_msg(bot, update):
     """Handler for all other text messages
 
-    Are passed to DialogFlow AI
+    Are answered by the small talk subsystem
     """
-    request = apiai.ApiAI('e0f0ee1fd08b4160bdb26c69df632678').text_request()
-    request.lang = 'ru'
-    request.session_id = 'MotoChatAIBot'
-    request.query = update.message.text
-    response_json = json.loads(request.getresponse().read().decode('utf-8'))
-    response = response_json['result']['fulfillment']['speech']
+    response = smalltalk.reply(update.message.text)
     if response:
         bot.send_message(chat_id=update.message.chat_id, text=response)
     else:
@@ -114,9 +130,17 @@ def unknown(bot, update):
     bot.send_message(chat_id=update.message.chat_id, text="Извини, не знаю такой команды.")
 
 
-def run_bot():
-    pp = PicklePersistence(filename='conversationbot')
-    updater = Updater(token=BOT_TOKEN, persistence=pp)
+def build_updater(shard=0, shards=1):
+    """Create the updater with all the bot handlers registered
+
+    :param int shard: the cluster worker number, when run in a cluster
+    :param int shards: the number of cluster workers
+    """
+    pp = PostgresPersistence(shard, shards)
+    # Updater sizes the pool of its own bot for 4 async workers and 4 more threads,
+    # the update workers call the bot too
+    bot = OutboxBot(BOT_TOKEN, request=Request(con_pool_size=UPDATE_WORKERS + 8))
+    updater = Updater(bot=bot, persistence=pp)
     dispatcher = updater.dispatcher
 
     add_dialog_handler = CommandHandler('add', add, pass_user_data=True)
@@ -131,10 +155,12 @@ def run_bot():
         entry_points=[CommandHandler('remove', remove, pass_args=True, pass_user_data=True)],
         states={
             REMOVE_SCHEDULE_STATE: [MessageHandler(Filters.text, remove_schedule_continue, pass_user_data=True)],
+            ConversationHandler.TIMEOUT: timeout_handlers(dispatcher),
         },
         fallbacks=[CommandHandler('cancel', end_conversation)],
         name="remove_schedule",
-        # persistent=True
+        persistent=True,
+        conversation_timeout=SESSION_TIMEOUT
     )
     unknown_handler = MessageHandler(Filters.command, unknown)
 
@@ -144,10 +170,12 @@ def run_bot():
         states={
             ASK_GROUP_NUM_STATE: [MessageHandler(Filters.text, store_group_num)],
             ASK_LAST_NAME_STATE: [MessageHandler(Filters.text, store_last_name)],
+            ConversationHandler.TIMEOUT: timeout_handlers(dispatcher),
         },
         fallbacks=[CommandHandler('cancel', end_conversation)],
         name="identity_conversation",
-        # persistent=True
+        persistent=True,
+        conversation_timeout=SESSION_TIMEOUT
     )
 
     dispatcher.add_handler(identity_handler)
@@ -164,15 +192,17 @@ def run_bot():
 
     # Add subscribe handler with the states ASK_DATE_STATE, ASK_TIME_STATE
     sign_up_conv_handler = ConversationHandler(
-        entry_points=[RegexHandler(".*([Зз]апиши меня).*", ask_place)],
+        entry_points=[RegexHandler(".*([Зз]апиши меня).*", ask_place, pass_user_data=True)],
         states={
             ASK_PLACE_STATE: [MessageHandler(Filters.text, ask_date, pass_user_data=True)],
             ASK_DATE_STATE: [MessageHandler(Filters.text, ask_time, pass_user_data=True)],
             ASK_TIME_STATE: [MessageHandler(Filters.text, store_sign_up, pass_user_data=True)],
+            ConversationHandler.TIMEOUT: timeout_handlers(dispatcher),
         },
         fallbacks=[CommandHandler('cancel', end_conversation)],
         name="subscribe_conversation",
-        # persistent=True
+        persistent=True,
+        conversation_timeout=SESSION_TIMEOUT
     )
     dispatcher.add_handler(sign_up_conv_handler)
 
@@ -181,22 +211,113 @@ def run_bot():
         entry_points=[RegexHandler(".*([Оо]тпиши меня|[Оо]тмени запись).*", ask_unsubscribe)],
         states={
             RETURN_UNSUBSCRIBE_STATE: [MessageHandler(Filters.text, unsubscribe)],
+            ConversationHandler.TIMEOUT: timeout_handlers(dispatcher),
         },
         fallbacks=[CommandHandler('cancel', end_conversation)],
         name="unsubscribe_conversation",
-        # persistent=True
+        persistent=True,
+        conversation_timeout=SESSION_TIMEOUT
     )
     dispatcher.add_handler(unsubscribe_conv_handler)
 
-    text_msg_handler = MessageHandler(Filters.text, unknown)
+    text_msg_handler = MessageHandler(Filters.text, text_msg)
     dispatcher.add_handler(text_msg_handler)
 
+    sweeper = expire_sessions(dispatcher, [
+        identity_handler,
+        remove_schedule_handler,
+        sign_up_conv_handler,
+        unsubscribe_conv_handler,
+    ])
+
     # log all errors
     dispatcher.add_error_handler(error)
 
-    updater.start_polling(clean=True)
+    metrics.instrument_dispatcher(dispatcher)
+    metrics.register_gauge("bot_live_conversations", "Conversations in progress.", sweeper.live_conversations)
+    return updater
+
+
+def start_services(updater, num=0):
+    """Start the background services of a bot process
+
+    :param int num: the bot process number, only the first one sends the daily reminders
+    :return: the updates executor or None if updates are processed sequentially
+    """
+    executor = None
+    if UPDATE_WORKERS:
+        executor = run_concurrently(updater.dispatcher, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+        metrics.register_gauge("bot_update_queue_depth", "Updates waiting for a worker.", executor.queue_depth)
+    outbox.start()
+    if num == 0:
+        schedule_reminders(updater.job_queue)
+    start_availability(updater.job_queue)
+    if METRICS_PORT:
+        metrics.register_gauge("bot_outbox_queue_depth", "Outbound messages waiting.", outbox.queue_depth)
+        metrics.register_gauge("bot_outbox_sent_total", "Outbound messages sent.", lambda: outbox.sent)
+        metrics.register_gauge("bot_query_cache_hits", "Query cache hits.", lambda: db.query_cache.hits)
+        metrics.register_gauge("bot_query_cache_misses", "Query cache misses.", lambda: db.query_cache.misses)
+        metrics.start_server(METRICS_PORT + num)
+    return executor
+
+
+def stop_services(updater, executor):
+    """Stop taking updates, finish the queued ones and release the resources"""
+    updater.stop()
+    if executor:
+        executor.stop()
+    if updater.persistence:
+        updater.dispatcher.update_persistence()
+        updater.persistence.flush()
+    outbox.stop()
+    db.close_pool()
+
+
+def wait_for_stop():
+    """Block until SIGTERM or SIGINT is received
+
+    Updater.idle() can't be used, in webhook mode the updater is not running
+    and its signal handler exits right away skipping the shutdown.
+    """
+    stopped = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    while not stopped.wait(1):
+        pass
+    logger.info("Stopping the bot")
+
+
+def run_worker(num, updates):
+    """Entry point of a cluster worker process handling its shard of chats"""
+    updater = build_updater(num, BOT_PROCESSES)
+    executor = start_services(updater, num)
+    listener = cluster.ChangeListener()
+    listener.start()
+    start_dispatcher(updater)
+    cluster.feed(updater, updates)
+    listener.stop()
+    stop_services(updater, executor)
+
+
+def run_bot():
+    if BOT_PROCESSES > 1:
+        cluster.run_front(run_worker, BOT_PROCESSES)
+        return
+
+    updater = build_updater()
+    executor = start_services(updater)
+
+    listener = None
+    if UPDATES_MODE == 'webhook':
+        listener = start_webhook(updater, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                                 WEBHOOK_QUEUE_SIZE, WEBHOOK_URL)
+    else:
+        updater.start_polling(clean=True)
 
-    updater.idle()
+    wait_for_stop()
+    if listener:
+        listener.stop()
+    stop_services(updater, executor)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import datetime as dt
 import logging
 import re
 from functools import wraps
@@ -20,7 +21,31 @@ logger.setLevel(logging.INFO)
 # regex
 place_regex = re.compile("^({})$".format("|".join(PLACES)), flags=re.IGNORECASE)
 date_regex = re.compile(".*([0-9]{4}-[0-9]{2}-[0-9]{2}).*")
-time_regex = re.compile("^(" + "|".join(CLASSES_HOURS) + ")$")
+# time may be followed by the free seats hint of the keyboard button, e.g. "12:00 (мест 3)"
+time_regex = re.compile("^(" + "|".join(CLASSES_HOURS) + r")(?: \(.*\))?$")
+
+
+def start_of_the_week(today=None):
+    """Return the first day of the week subscriptions are counted for
+
+    On Sunday the upcoming week is already considered.
+    """
+    today = today or dt.date.today()
+    if today.weekday() == 6:
+        return today + dt.timedelta(days=1)
+    return today - dt.timedelta(days=today.weekday())
+
+
+def plural(num, forms):
+    """Return the russian noun form for the number
+
+    :param tuple forms: forms for 1, 2 and 5, e.g. ("запись", "записи", "записей")
+    """
+    if num % 10 == 1 and num % 100 != 11:
+        return forms[0]
+    if 2 <= num % 10 <= 4 and not 12 <= num % 100 <= 14:
+        return forms[1]
+    return forms[2]
 
 
 def restricted(msg="Ага, счас! Только администратору можно!", returns=None):
@@ -0,0 +1,41 @@
+"""
+Per-update user context.
+
+Everything the user handlers need to decide on an update, the upcoming
+bookings and the booking allowed flag, is fetched with a single query and
+kept in the query cache until a booking or the settings change.
+Free seats are served by the availability index and are not loaded here.
+"""
+import datetime as dt
+
+import db
+from config import DATE_FORMAT
+from tools import start_of_the_week
+
+# the context is served from the query cache until one of these is written to
+CONTEXT_TABLES = ("settings", "schedule", "classes")
+
+
+class UserContext:
+
+    def __init__(self, booking_allowed, bookings):
+        self.booking_allowed = booking_allowed
+        # (place, date, time) since the start of the current week, ordered by date and time
+        self.bookings = bookings
+
+    def bookings_since(self, date):
+        return [booking for booking in self.bookings if booking[1] >= date]
+
+    def bookings_on(self, date):
+        return [booking for booking in self.bookings if booking[1] == date]
+
+
+def load_user_context(user_id):
+    """Load the user context in one db round trip"""
+    allow, bookings = db.execute_select(
+        db.get_user_context_sql, {'user_id': user_id, 'since': start_of_the_week().isoformat()},
+        cache_tables=CONTEXT_TABLES)[0]
+    return UserContext(
+        booking_allowed=allow != 'no',
+        bookings=[(place, dt.datetime.strptime(date, DATE_FORMAT).date(), time) for place, date, time in bookings],
+    )
@@ -6,27 +6,35 @@ from telegram import InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import ConversationHandler
 
 import db
+import student_lists
+from availability import index as availability
 from config import (
     ASK_DATE_STATE,
     ASK_GROUP_NUM_STATE,
     ASK_LAST_NAME_STATE,
     ASK_PLACE_STATE,
     ASK_TIME_STATE,
-    CLOSED,
     DATE_FORMAT,
     LIST_OF_ADMINS,
-    OPEN,
     PEOPLE_PER_TIME_SLOT,
     PLACES,
     RETURN_UNSUBSCRIBE_STATE,
+    SUBSCRIPTIONS_PER_WEEK,
     WEEKDAYS_SHORT
 )
+from schedule_report import report
 from tools import (
     ReplyKeyboardWithCancel,
     date_regex,
     place_regex,
+    plural,
+    start_of_the_week,
     time_regex
 )
+from user_context import load_user_context
+
+WEEK_LIMIT_TEXT = "У тебя уже есть {} {} на эту неделю. Сначала отмени другую запись.".format(
+    SUBSCRIPTIONS_PER_WEEK, plural(SUBSCRIPTIONS_PER_WEEK, ("запись", "записи", "записей")))
 
 
 # commands
@@ -36,6 +44,8 @@ def start_cmd(bot, update):
     first_name = update.effective_user.first_name
     last_name = update.effective_user.last_name
     db.upsert_user(user_id, nick, first_name, last_name)
+    report.user_changed(user_id)
+    student_lists.invalidate()
     bot.send_message(chat_id=update.message.chat_id,
                      text="Привет! Я MD-помошник. Буду вас записывать на занятия. "
                           "Записаться можно при наличии времени в расписании, написав мне \"запиши меня\". "
@@ -46,26 +56,25 @@ def start_cmd(bot, update):
     return ASK_GROUP_NUM_STATE
 
 
-def ask_place(bot, update):
-    """Entry point for 'subscribe' user conversation"""
-    subscription_allowed = db.execute_select(db.get_settings_param_value, ("allow",))[0][0]
-    if subscription_allowed == 'no':
+def ask_place(bot, update, user_data):
+    """Entry point for 'subscribe' user conversation
+
+    The dates the user has booked are kept for ask_time, so the context is loaded once per conversation.
+    """
+    user_id = update.effective_user.id
+    context = load_user_context(user_id)
+    if not context.booking_allowed:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Сейчас запись на занятия закрыта.",
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    user_id = update.effective_user.id
-    today = dt.date.today()
-    if today.weekday() == 6:
-        start_of_the_week = today + dt.timedelta(days=1)
-    else:
-        start_of_the_week = today - dt.timedelta(days=today.weekday())
-    subs = db.execute_select(db.get_user_subscriptions_sql, (user_id, start_of_the_week.isoformat()))
-    if user_id not in LIST_OF_ADMINS and len(subs) > 1:
+    subs = context.bookings_since(start_of_the_week())
+    if user_id not in LIST_OF_ADMINS and len(subs) >= SUBSCRIPTIONS_PER_WEEK:
         bot.send_message(chat_id=update.message.chat_id,
-                         text="У тебя уже есть две записи на эту неделю. Сначала отмени другую запись.",
+                         text=WEEK_LIMIT_TEXT,
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
+    user_data['booked_dates'] = [date.isoformat() for place, date, time in context.bookings]
     keyboard = [[InlineKeyboardButton(place, callback_data=place)] for place in PLACES]
     reply_markup = ReplyKeyboardWithCancel(keyboard, one_time_keyboard=True)
     bot.send_message(chat_id=update.message.chat_id,
@@ -95,12 +104,11 @@ def ask_date(bot, update, user_data):
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
     user_data['place'] = place
-    open_dates = db.execute_select(db.get_open_classes_dates_sql,
-                                   ((dt.date.today() + dt.timedelta(days=1)).isoformat(), place))
+    open_dates = availability.open_dates(place, dt.date.today() + dt.timedelta(days=1))
     if open_dates:
         keyboard = [[
             InlineKeyboardButton(
-                "{} {} (свободно слотов {})".format(WEEKDAYS_SHORT[date.weekday()], date, count),
+                "{} {} (свободно мест {})".format(WEEKDAYS_SHORT[date.weekday()], date, count),
                 callback_data=str(date)
             )
         ] for date, count in open_dates]
@@ -156,11 +164,14 @@ def ask_time(bot, update, user_data):
                               "Можно записываться на 'завтра' и позже.",
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    date = date.isoformat()
     # check for existing subscription for the date, 2 subs are not allowed per user per date
     user_id = update.effective_user.id
-    subs = db.execute_select(db.get_user_subscriptions_for_date_sql, (user_id, date))
-    if user_id not in LIST_OF_ADMINS and len(subs) > 0:
+    booked_dates = user_data.get('booked_dates')
+    if booked_dates is None:
+        # the conversation was started before the booked dates were kept
+        booked_dates = [booking[1].isoformat() for booking in load_user_context(user_id).bookings_on(date)]
+    date = date.isoformat()
+    if user_id not in LIST_OF_ADMINS and date in booked_dates:
         bot.send_message(chat_id=update.message.chat_id,
                          text="У тебя уже есть запись на {}. "
                               "Чтобы записаться отмени ранее сделанную запись.".format(date),
@@ -168,10 +179,9 @@ def ask_time(bot, update, user_data):
         return ConversationHandler.END
     user_data['date'] = date
     place = user_data['place']
-    time_slots = db.execute_select(db.get_open_classes_time_sql, (date, place))
-    time_slots = map(lambda x: x[0], time_slots)
-    # TODO: show count of open positions per time
-    keyboard = [[InlineKeyboardButton(str(time), callback_data=str(time))] for time in time_slots]
+    time_slots = availability.open_times(place, date)
+    keyboard = [[InlineKeyboardButton("{} (мест {})".format(time, free), callback_data=str(time))]
+                for time, free in time_slots]
     reply_markup = ReplyKeyboardWithCancel(keyboard, one_time_keyboard=True)
     bot.send_message(chat_id=update.message.chat_id,
                      text="Теперь выбери время",
@@ -200,30 +210,38 @@ def store_sign_up(bot, update, user_data):
         return ConversationHandler.END
     date = user_data['date']
     place = user_data['place']
-    time = match.string
+    time = match.group(1)
     user_id = update.effective_user.id
+    # admins are not limited, as well as the students they add
+    check_limits = user_id not in LIST_OF_ADMINS
     # logic for admins to add students
     if user_id in LIST_OF_ADMINS:
         student_id = user_data.get('student_id')
         if student_id:
             user_id = student_id
             del (user_data['student_id'])
-    class_id = db.execute_select(db.get_class_id_sql, (date, time, place))[0][0]
-    db.execute_insert(db.set_user_subscription_sql, (user_id, class_id))
-    # check if class is full (PEOPLE_PER_TIME_SLOT)
-    people_count = db.execute_select(db.get_people_count_per_time_slot_sql, (date, time, place))[0][0]
-    if people_count > PEOPLE_PER_TIME_SLOT:
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Упс, на этот тайм слот уже записалось больше {} человек. "
-                              "Попробуй еще раз на другой.".format(PEOPLE_PER_TIME_SLOT))
-        db.execute_insert(db.delete_user_subscription_sql, (user_id, class_id))
+    try:
+        outcome = db.book_class(user_id, place, date, time, start_of_the_week().isoformat(), check_limits)
+    except DBError:
+        outcome = None
+    if outcome == db.BOOKED:
+        report.add_booking(user_id, place, date, time)
+        availability.booked(place, date, time)
+        text = "Ok, записал на {} {} {}".format(place, date, time)
+    elif outcome == db.CLASS_FULL:
+        availability.full(place, date, time)
+        text = ("Упс, на этот тайм слот уже записалось {} человек. "
+                "Попробуй еще раз на другой.".format(PEOPLE_PER_TIME_SLOT))
+    elif outcome == db.DATE_LIMIT:
+        text = ("У тебя уже есть запись на {}. "
+                "Чтобы записаться отмени ранее сделанную запись.".format(date))
+    elif outcome == db.WEEK_LIMIT:
+        text = WEEK_LIMIT_TEXT
     else:
-        if people_count == PEOPLE_PER_TIME_SLOT:
-            # set class open = False
-            db.execute_insert(db.set_class_state, (CLOSED, class_id))
-        bot.send_message(chat_id=update.message.chat_id,
-                         text="Ok, записал на {} {} {}".format(place, date, time),
-                         reply_markup=ReplyKeyboardRemove())
+        text = "Что-то пошло не так. Попробуй еще раз."
+    bot.send_message(chat_id=update.message.chat_id,
+                     text=text,
+                     reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
@@ -232,15 +250,14 @@ def ask_unsubscribe(bot, update):
 
     Offer only subscriptions starting from 'tomorrow' for cancel.
     """
-    subscription_allowed = db.execute_select(db.get_settings_param_value, ("allow",))[0][0]
-    if subscription_allowed == 'no':
+    user_id = update.effective_user.id
+    context = load_user_context(user_id)
+    if not context.booking_allowed:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Сейчас редактирование записи на занятия закрыто.",
                          reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-    user_id = update.effective_user.id
-    user_subs = db.execute_select(db.get_user_subscriptions_sql,
-                                  (user_id, (dt.date.today() + dt.timedelta(days=1)).isoformat()))
+    user_subs = context.bookings_since(dt.date.today() + dt.timedelta(days=1))
     if user_subs:
         keyboard = [[InlineKeyboardButton("{} {} {}".format(place, date, time), callback_data=(str(date), time))]
                     for place, date, time in user_subs]
@@ -284,14 +301,15 @@ def unsubscribe(bot, update):
                              reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
         user_id = update.effective_user.id
-        class_id = db.execute_select(db.get_class_id_sql, (date, time, place))[0][0]
-        db.execute_insert(db.delete_user_subscription_sql, (user_id, class_id))
-        people_count = db.execute_select(db.get_people_count_per_time_slot_sql, (date, time, place))[0][0]
-        if people_count < PEOPLE_PER_TIME_SLOT:
-            # set class open = True
-            db.execute_insert(db.set_class_state, (OPEN, class_id))
+        outcome = db.unbook_class(user_id, place, date, time)
+        if outcome == db.UNBOOKED:
+            report.remove_booking(user_id, place, date, time)
+            availability.unbooked(place, date, time)
+            text = "Ok, удалил запись на {} {} {}".format(place, date, time)
+        else:
+            text = "Не нашел такой записи. Попробуй еще раз."
         bot.send_message(chat_id=update.message.chat_id,
-                         text="Ok, удалил запись на {} {} {}".format(place, date, time),
+                         text=text,
                          reply_markup=ReplyKeyboardRemove())
     except (ValueError, DBError):
         bot.send_message(chat_id=update.message.chat_id,
@@ -315,6 +333,8 @@ def store_group_num(bot, update):
                          text="Я немного не понял. Просто напиши номер своей группы.")
         return ASK_GROUP_NUM_STATE
     db.execute_insert(db.update_user_group_sql, (int(group_num), user_id))
+    report.update_user(user_id, group_num=int(group_num))
+    student_lists.invalidate()
     bot.send_message(chat_id=update.message.chat_id,
                      text="Теперь напиши, пожалуйста, фамилию.")
     return ASK_LAST_NAME_STATE
@@ -327,10 +347,11 @@ def store_last_name(bot, update):
         bot.send_message(chat_id=update.message.chat_id,
                          text="Я немного не понял. Просто напиши свою фамилию.")
         return ASK_LAST_NAME_STATE
-    db.execute_insert(db.update_user_last_name_sql, (surname, user_id))
-    user = db.execute_select(db.get_user_sql, (user_id,))[0]
+    last_name, group_num = db.execute_returning(db.update_user_last_name_returning_sql, (surname, user_id))[0]
+    report.update_user(user_id, last_name=surname)
+    student_lists.invalidate()
     bot.send_message(chat_id=update.message.chat_id,
                      text="Спасибо. Я тебя записал. Твоя фамилия {}, и ты из {} группы правильно? Если нет,"
                           " то используй команду /start чтобы изменить данные о себе."
-                          " Если всё верно, попробуй записаться. Напиши 'Запиши меня'.".format(user[3], user[4]))
+                          " Если всё верно, попробуй записаться. Напиши 'Запиши меня'.".format(last_name, group_num))
     return ConversationHandler.END
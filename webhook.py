@@ -0,0 +1,99 @@
+"""
+Webhook ingestion mode.
+
+An embedded HTTP listener accepts updates Telegram pushes to the secret path
+and puts them into the dispatcher queue. When too many updates are waiting
+the listener answers 503, so Telegram redelivers them later instead of the
+bot piling them up in memory.
+
+To try it locally POST a recorded update:
+    curl -X POST -d @update.json http://localhost:8443/<WEBHOOK_SECRET>
+"""
+import hmac
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram import Update
+
+from tools import logger
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(bot, update_queue, secret, queue_size):
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if not hmac.compare_digest(self.path.strip("/"), secret):
+                self.send_response(404)
+                self.end_headers()
+                return
+            if update_queue.qsize() >= queue_size:
+                self.send_response(503)
+                self.end_headers()
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(length).decode('utf-8'))
+                update = Update.de_json(data, bot)
+            except (ValueError, TypeError, KeyError) as e:
+                logger.warning("Bad webhook request: %s", e)
+                self.send_response(400)
+                self.end_headers()
+                return
+            update_queue.put(update)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug("Webhook: " + format, *args)
+
+    return WebhookHandler
+
+
+class WebhookListener:
+
+    def __init__(self, bot, update_queue, secret, listen, port, queue_size):
+        self.bot = bot
+        self.secret = secret
+        handler = make_handler(bot, update_queue, secret, queue_size)
+        self._server = ThreadingHTTPServer((listen, port), handler)
+        self._thread = None
+
+    def start(self, webhook_url=None):
+        """Start listening and register the webhook if the public url is given"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook_listener", daemon=True)
+        self._thread.start()
+        if webhook_url:
+            self.bot.set_webhook(url="{}/{}".format(webhook_url.rstrip("/"), self.secret))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+def start_dispatcher(updater):
+    """Run the dispatcher and the job queue without the updater polling"""
+    threading.Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True).start()
+    updater.job_queue.start()
+
+
+def start_webhook(updater, secret, listen, port, queue_size, webhook_url=None):
+    """Run the dispatcher fed by the webhook listener instead of polling
+
+    :return: the started WebhookListener
+    """
+    if not secret:
+        raise ValueError("WEBHOOK_SECRET is required in webhook mode")
+    start_dispatcher(updater)
+    listener = WebhookListener(updater.bot, updater.dispatcher.update_queue, secret, listen, port, queue_size)
+    listener.start(webhook_url)
+    logger.info("Webhook listener started on %s:%s", listen, port)
+    return listener
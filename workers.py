@@ -0,0 +1,86 @@
+"""
+Concurrent update processing keeping updates of the same chat in order.
+
+Updates are routed to a fixed pool of worker threads by hashing the chat id.
+Every worker has its own bounded queue, so updates of one chat are always
+handled one after another by the same worker and ConversationHandler states
+stay correct, while slow handlers of one chat don't block the other chats.
+"""
+import queue
+import threading
+
+from tools import logger
+
+
+def chat_key(update):
+    """Return the key updates are ordered by"""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    return 0
+
+
+def shard_of(chat_id, shards):
+    """Return the index of the shard the chat belongs to"""
+    return chat_id % shards
+
+
+def shard_for(update, shards):
+    """Return the index of the shard the update belongs to"""
+    return shard_of(chat_key(update), shards)
+
+
+class ChatOrderedExecutor:
+
+    def __init__(self, handle, workers, queue_size):
+        """
+        :param handle: callable processing a single update
+        :param int workers: number of worker threads
+        :param int queue_size: max updates waiting per worker, submit blocks when full
+        """
+        self.handle = handle
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        for num, updates in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(updates,), name=f"update_worker_{num}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for updates in self._queues:
+            updates.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, update):
+        self._queues[shard_for(update, len(self._queues))].put(update)
+
+    def queue_depth(self):
+        return sum(updates.qsize() for updates in self._queues)
+
+    def _run(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            try:
+                self.handle(update)
+            except Exception as e:
+                logger.error("Update %s processing failed: %s", update, e)
+
+
+def run_concurrently(dispatcher, workers, queue_size):
+    """Make the dispatcher hand updates over to a ChatOrderedExecutor
+
+    :return: the started executor
+    """
+    executor = ChatOrderedExecutor(dispatcher.process_update, workers, queue_size)
+    executor.start()
+    dispatcher.process_update = executor.submit
+    return executor